@@ -0,0 +1,148 @@
+import logging
+import queue
+import threading
+import time
+
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+
+class InfluxBatchWriter:
+    """
+    Micro-batching InfluxDB writer shared by the MQTT webhooks.
+
+    write() only puts points on a bounded queue, so the paho network loop
+    never waits on HTTP. A background thread flushes the queue to InfluxDB
+    whenever batch_size points are waiting or flush_interval seconds passed.
+    When InfluxDB is slow the queue fills up and write() blocks for up to
+    put_timeout seconds per call (backpressure) before dropping the points
+    it could not queue.
+    """
+
+    def __init__(self, client, bucket: str, org: str, batch_size: int = 500, flush_interval: float = 1.0,
+                 max_queue: int = 10000, put_timeout: float = 5.0, retries: int = 3, backoff: float = 0.5,
+                 report_interval: float = 60.0, logger: logging.Logger = None):
+        self.bucket = bucket
+        self.org = org
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.report_interval = report_interval
+        self.logger = logger or logging.getLogger("INFLUX-WRITER")
+
+        self.write_api = client.write_api(write_options=SYNCHRONOUS)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._stats_lock = threading.Lock()
+        self._stats = {"written": 0, "dropped": 0, "failed": 0, "flushes": 0,
+                       "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0}
+        self._last_report = time.monotonic()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="influx-batch-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def write(self, points) -> bool:
+        """
+        Queues one point or a list of points for the next flush.
+
+        All points of the call share one put_timeout deadline, so a stalled
+        InfluxDB blocks the caller for at most put_timeout seconds however
+        many points it passes. Points still unqueued at the deadline are
+        dropped.
+
+        Returns:
+            bool: False if any point was dropped because the queue stayed full.
+        """
+        if not isinstance(points, (list, tuple)):
+            points = [points]
+
+        deadline = time.monotonic() + self.put_timeout
+        queued = 0
+        for point in points:
+            try:
+                self._queue.put(point, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+            queued += 1
+
+        dropped = len(points) - queued
+        if dropped:
+            with self._stats_lock:
+                self._stats["dropped"] += dropped
+            self.logger.error(f"InfluxDB write queue is full, dropped {dropped} of {len(points)} points")
+        return not dropped
+
+    def _run(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._flush(batch)
+            self._report()
+
+    def _flush(self, batch):
+        start = time.monotonic()
+        for attempt in range(self.retries + 1):
+            try:
+                self.write_api.write(bucket=self.bucket, org=self.org, record=batch)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    self.logger.error(f"Failed to write {len(batch)} points to InfluxDB: {str(e)}")
+                    with self._stats_lock:
+                        self._stats["failed"] += len(batch)
+                    return
+                time.sleep(self.backoff * 2 ** attempt)
+
+        latency_ms = (time.monotonic() - start) * 1000
+        with self._stats_lock:
+            self._stats["written"] += len(batch)
+            self._stats["flushes"] += 1
+            self._stats["last_flush_ms"] = latency_ms
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], latency_ms)
+            self._stats["total_flush_ms"] += latency_ms
+
+    def _report(self):
+        if time.monotonic() - self._last_report < self.report_interval:
+            return
+        self._last_report = time.monotonic()
+        stats = self.stats()
+        self.logger.info(
+            f"InfluxDB writer: {stats['written']} written, {stats['queued']} queued, {stats['dropped']} dropped, "
+            f"{stats['failed']} failed, flush latency avg {stats['avg_flush_ms']:.1f} ms / max {stats['max_flush_ms']:.1f} ms"
+        )
+
+    def stats(self) -> dict:
+        """
+        Counters and flush latency (ms) since the writer was created.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize()
+        stats["avg_flush_ms"] = stats["total_flush_ms"] / stats["flushes"] if stats["flushes"] else 0.0
+        return stats
+
+    def close(self, timeout: float = 30.0):
+        """
+        Flushes whatever is still queued and stops the background thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.write_api.close()
@@ -0,0 +1,261 @@
+from influxdb_client import InfluxDBClient
+import json
+from paho.mqtt.client import Client
+import os
+import sys
+import queue
+import threading
+import time
+import logging
+import logging.config
+from dotenv import load_dotenv
+from InfluxBatchWriter import InfluxBatchWriter
+from measurements import car_point, station_point, satellite_point, convert_entities
+
+# The live heatmap lives in the interpolation package next to this one
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "interpolation"))
+from LiveHeatmap import live_heatmap_from_env, save_forever
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logging.config.fileConfig('../../logging.conf')
+logger = logging.getLogger("INGESTION")
+
+token = os.getenv('GRAFANA_READ_AND_WRITE')
+org = 'students'
+bucket = 'APARS'
+client = InfluxDBClient(url=os.getenv("INFLUX_URL"), token=token, org=org)
+writer = InfluxBatchWriter(client, bucket, org, logger=logger)
+
+MQTT_BROKER = os.getenv("MQTT_ADDRESS")
+MQTT_PORT = int(os.getenv("MQTT_PORT"))
+MQTT_TOPICS = {
+    "station": "station",
+    "car": "car",
+    "satellite": "satellite"
+}
+
+# Worker threads and queue size of every topic
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", 4))
+INGESTION_QUEUE_SIZE = int(os.getenv("INGESTION_QUEUE_SIZE", 1000))
+# Seconds on_message waits for room in a full queue before dropping the message
+INGESTION_PUT_TIMEOUT = float(os.getenv("INGESTION_PUT_TIMEOUT", 1.0))
+INGESTION_REPORT_INTERVAL = float(os.getenv("INGESTION_REPORT_INTERVAL", 60))
+
+LIVE_HEATMAP_DIR = os.getenv("LIVE_HEATMAP_DIR", ".")
+# Seconds between two saves of a live heatmap, done by one saver thread per heatmap
+LIVE_HEATMAP_SAVE_INTERVAL = float(os.getenv("LIVE_HEATMAP_SAVE_INTERVAL", 30))
+
+
+# Same snapshot files the single topic webhooks wrote
+LIVE_HEATMAP_FILES = {
+    "car": os.path.join(LIVE_HEATMAP_DIR, "live_heatmap_car.npz"),
+    "station": os.path.join(LIVE_HEATMAP_DIR, "live_heatmap_station.npz"),
+}
+# (heatmap, file) per topic, filled by start_mqtt with the heatmaps that could be built
+live_heatmaps = {}
+
+
+def queue_entities(data, convert, measurement):
+    """
+    Converts every entity of the notification and queues the points as one batch.
+
+    Returns:
+        list: The convert results.
+    """
+    results, errors = convert_entities(data["data"], convert)
+    for entity_id, e in errors:
+        logger.error(f"Failed to convert data for ID '{entity_id}': {str(e)}")
+    if results:
+        writer.write([result[0] if isinstance(result, tuple) else result for result in results])
+        logger.debug(f"Data for {len(results)} ID(s) queued for InfluxDB under measurement '{measurement}'.")
+    return results
+
+
+def update_live_heatmap(topic, results):
+    """
+    Adds the readings to the topic's live heatmap. Saving is left to its
+    saver thread, so the workers never write the snapshot concurrently.
+    """
+    if topic not in live_heatmaps:
+        return
+    live_heatmap, _ = live_heatmaps[topic]
+    added = sum(live_heatmap.add(*reading) for _, reading in results)
+    if added < len(results):
+        logger.debug(f"{len(results) - added} of {len(results)} {topic} reading(s) were outside the live heatmap "
+                     f"or too old for it")
+
+
+def handle_car(data):
+    update_live_heatmap("car", queue_entities(data, car_point, 'car_metrics'))
+
+
+def handle_station(data):
+    update_live_heatmap("station", queue_entities(data, station_point, 'station_aqi'))
+
+
+def handle_satellite(data):
+    queue_entities(data, satellite_point, 'satellite_metrics')
+
+
+class TopicWorkers:
+    """
+    Bounded queue of raw MQTT payloads drained by a pool of worker threads.
+
+    The paho network loop only enqueues, JSON decoding, AQI conversion and
+    the heatmap update run on the workers. When the queue stays full for
+    put_timeout seconds the message is dropped and counted.
+    """
+
+    def __init__(self, topic: str, handler, workers: int, max_queue: int, put_timeout: float):
+        self.topic = topic
+        self.handler = handler
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+
+        self._stats_lock = threading.Lock()
+        self._stats = {"received": 0, "processed": 0, "failed": 0, "dropped": 0}
+        self._last_processed = 0
+        self._last_report = time.monotonic()
+
+    def start(self):
+        for k in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"ingest-{self.topic}-{k}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, payload: bytes) -> bool:
+        with self._stats_lock:
+            self._stats["received"] += 1
+        try:
+            self._queue.put(payload, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            with self._stats_lock:
+                self._stats["dropped"] += 1
+            logger.error(f"Queue of topic '{self.topic}' is full, dropped message")
+            return False
+
+    def _work(self):
+        while True:
+            payload = self._queue.get()
+            if payload is None:
+                self._queue.task_done()
+                return
+            try:
+                self.handler(json.loads(payload))
+                outcome = "processed"
+            except Exception as e:
+                logger.error(f"Error processing MQTT message on topic {self.topic}: {e}")
+                outcome = "failed"
+            with self._stats_lock:
+                self._stats[outcome] += 1
+            self._queue.task_done()
+
+    def stats(self) -> dict:
+        """
+        Counters since start, the current queue depth and the throughput
+        (processed messages per second) since the previous call.
+        """
+        now = time.monotonic()
+        with self._stats_lock:
+            stats = dict(self._stats)
+            elapsed = now - self._last_report
+            stats["per_second"] = (stats["processed"] - self._last_processed) / elapsed if elapsed > 0 else 0.0
+            self._last_processed = stats["processed"]
+            self._last_report = now
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+    def close(self, timeout: float = 10.0):
+        """
+        Lets the workers finish the queued messages and stops them.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+
+topic_workers = {
+    MQTT_TOPICS["car"]: TopicWorkers("car", handle_car, INGESTION_WORKERS, INGESTION_QUEUE_SIZE, INGESTION_PUT_TIMEOUT),
+    MQTT_TOPICS["station"]: TopicWorkers("station", handle_station, INGESTION_WORKERS, INGESTION_QUEUE_SIZE, INGESTION_PUT_TIMEOUT),
+    MQTT_TOPICS["satellite"]: TopicWorkers("satellite", handle_satellite, INGESTION_WORKERS, INGESTION_QUEUE_SIZE, INGESTION_PUT_TIMEOUT),
+}
+
+
+def report_forever(stop):
+    while not stop.wait(INGESTION_REPORT_INTERVAL):
+        for workers in topic_workers.values():
+            stats = workers.stats()
+            logger.info(
+                f"Topic '{workers.topic}': {stats['received']} received, {stats['processed']} processed, "
+                f"{stats['failed']} failed, {stats['dropped']} dropped, {stats['queued']} queued, "
+                f"{stats['per_second']:.1f} msg/s"
+            )
+        for topic, (live_heatmap, _) in live_heatmaps.items():
+            logger.info(f"Live heatmap '{topic}': {len(live_heatmap)} readings, rejected {live_heatmap.rejected}")
+
+
+def on_connect(client, userdata, flags, rc):
+    logger.info(f"Connected to MQTT broker with result code {rc}")
+    # Subscribe to topics
+    for topic in MQTT_TOPICS.values():
+        client.subscribe(topic)
+        logger.info(f"Subscribed to topic: {topic}")
+
+
+def on_message(client, userdata, msg):
+    workers = topic_workers.get(msg.topic)
+    if workers is None:
+        logger.warning(f"Received MQTT message on unknown topic {msg.topic}")
+        return
+    workers.submit(msg.payload)
+
+
+def start_mqtt():
+    mqtt_client = Client()
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_message = on_message
+    mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+
+    for topic, file_name in LIVE_HEATMAP_FILES.items():
+        live_heatmap = live_heatmap_from_env(logger)
+        if live_heatmap is not None:
+            live_heatmaps[topic] = (live_heatmap, file_name)
+
+    writer.start()
+    for workers in topic_workers.values():
+        workers.start()
+    stop = threading.Event()
+    threading.Thread(target=report_forever, args=(stop,), name="ingest-report", daemon=True).start()
+    # Savers stop after the workers, so their final save holds every queued reading
+    saver_stop = threading.Event()
+    savers = [
+        threading.Thread(target=save_forever, args=(live_heatmap, file_name, saver_stop),
+                         kwargs={"interval": LIVE_HEATMAP_SAVE_INTERVAL, "logger": logger},
+                         name=f"live-heatmap-{topic}", daemon=True)
+        for topic, (live_heatmap, file_name) in live_heatmaps.items()
+    ]
+    for saver in savers:
+        saver.start()
+
+    try:
+        mqtt_client.loop_forever()
+    finally:
+        stop.set()
+        for workers in topic_workers.values():
+            workers.close()
+        saver_stop.set()
+        for saver in savers:
+            saver.join()
+        writer.close()
+
+
+if __name__ == '__main__':
+    start_mqtt()
@@ -0,0 +1,161 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pytz
+from influxdb_client import Point
+
+from Converters import Converters
+
+converter = Converters()
+
+# Influence radius (degrees) of a reading on the live heatmap
+CAR_INFLUENCE_RADIUS = 0.01
+STATION_INFLUENCE_RADIUS = 0.02
+
+# A located AQI reading, as fed to the live heatmap
+Reading = namedtuple("Reading", ["latitude", "longitude", "aqi", "radius", "observed_at"])
+
+
+def toUTC(timestamp):
+    if timestamp.endswith("Z"):
+        utc_time = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+        adjusted_time = utc_time - timedelta(hours=2)
+        return adjusted_time.isoformat(timespec='microseconds')
+    else:
+        local_time = datetime.fromisoformat(timestamp)
+        if local_time.tzinfo is not None:
+            return local_time.astimezone(pytz.utc).replace(tzinfo=None).isoformat(timespec='microseconds')
+        utc_plus_2 = pytz.timezone('Europe/Athens')
+        localized_time = utc_plus_2.localize(local_time)
+        utc_time = localized_time.astimezone(pytz.utc)
+        return utc_time.replace(tzinfo=None).isoformat(timespec='microseconds')
+
+
+def observed_utc(timestamp):
+    """
+    Naive UTC datetime of an Orion dateObserved, for the live heatmap window.
+
+    toUTC shifts "Z" timestamps by two more hours, which the Influx series
+    keep for compatibility. A reading fed to the heatmap that way would be
+    two hours old on arrival and fall out of its window, so here a trailing
+    Z is taken as real UTC.
+    """
+    if timestamp.endswith("Z"):
+        return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+    return datetime.fromisoformat(toUTC(timestamp))
+
+
+def car_point(payload):
+    """
+    Converts a CarAirQualityObserved entity to its 'car_metrics' point.
+
+    The pollutant values are replaced by their AQI (10 when out of range) and
+    the highest one becomes the reading's AQI.
+
+    Returns:
+        tuple: (Point, Reading)
+    """
+    max_aqi = 0
+    for param in ['pm1', 'pm25', 'pm10', 'co', 'co2']:
+        payload[param]['value'] = converter.getAQI(param, payload[param]['value'])
+        if payload[param]['value'] == None:
+            payload[param]['value'] = 10
+        if payload[param]['value'] >= max_aqi:
+            max_aqi = payload[param]['value']
+
+    observed_at = toUTC(payload['dateObserved']['value'])
+    latitude = float(payload['location']['value']['coordinates'][0])
+    longitude = float(payload['location']['value']['coordinates'][1])
+
+    point = Point('car_metrics') \
+            .tag("id", str(payload['id'])) \
+            .field("pm1", float(payload['pm1']['value'])) \
+            .field("pm25", float(payload['pm25']['value'])) \
+            .field("pm10", float(payload['pm10']['value'])) \
+            .field("co", float(payload['co']['value'])) \
+            .field("co2", float(payload['co2']['value'])) \
+            .field("aqi", int(max_aqi)) \
+            .time(observed_at) \
+            .field("latitude", latitude) \
+            .field("longitude", longitude)
+
+    return point, Reading(latitude, longitude, max_aqi, CAR_INFLUENCE_RADIUS,
+                          observed_utc(payload['dateObserved']['value']))
+
+
+def station_point(payload):
+    """
+    Converts a StationAirQualityObserved entity to its 'station_aqi' point.
+
+    Returns:
+        tuple: (Point, Reading)
+    """
+    observed_at = toUTC(payload['dateObserved']['value'])
+    latitude = float(payload['location']['value']['coordinates'][0])
+    longitude = float(payload['location']['value']['coordinates'][1])
+
+    point = Point('station_aqi') \
+            .tag("id", str(payload['id'])) \
+            .field("aqi", int(payload['aqi']['value'])) \
+            .time(observed_at) \
+            .field("latitude", latitude) \
+            .field("longitude", longitude)
+
+    return point, Reading(latitude, longitude, int(payload['aqi']['value']), STATION_INFLUENCE_RADIUS,
+                          observed_utc(payload['dateObserved']['value']))
+
+
+def metrics_point(payload, measurement_type):
+    """
+    Converts an entity with raw pollutant values to a point of measurement_type.
+    """
+    return Point(measurement_type) \
+            .tag("id", str(payload['id'])) \
+            .field("pm1", float(payload['pm1']['value'])) \
+            .field("pm25", float(payload['pm25']['value'])) \
+            .field("pm10", float(payload['pm10']['value'])) \
+            .field("co", float(payload['co']['value'])) \
+            .field("co2", float(payload['co2']['value'])) \
+            .time(toUTC(payload['dateObserved']['value'])) \
+            .field("latitude", float(payload['location']['value']['coordinates'][0])) \
+            .field("longitude", float(payload['location']['value']['coordinates'][1]))
+
+
+def satellite_point(payload):
+    """
+    Converts a SatelliteAirQualityObserved entity to a 'satellite_metrics' point.
+
+    Satellite entities carry one CAMS variable each, so every numeric
+    attribute becomes a field. Their coordinates are [lon, lat].
+    """
+    point = Point('satellite_metrics') \
+            .tag("id", str(payload['id'])) \
+            .time(toUTC(payload['dateObserved']['value'])) \
+            .field("latitude", float(payload['location']['value']['coordinates'][1])) \
+            .field("longitude", float(payload['location']['value']['coordinates'][0]))
+
+    for key, attribute in payload.items():
+        if key in ['id', 'type', 'dateObserved', 'location'] or not isinstance(attribute, dict):
+            continue
+        if isinstance(attribute.get('value'), (int, float)) and not isinstance(attribute.get('value'), bool):
+            point.field(key, float(attribute['value']))
+    return point
+
+
+def convert_entities(entities, convert):
+    """
+    Converts every entity of an Orion notification with convert in one pass.
+
+    An entity that fails to convert is reported instead of aborting the
+    others.
+
+    Returns:
+        tuple: (list of convert results, list of (entity id, exception))
+    """
+    results, errors = [], []
+    for entity in entities:
+        try:
+            results.append(convert(entity))
+        except Exception as e:
+            errors.append((entity.get('id') if isinstance(entity, dict) else None, e))
+    return results, errors
@@ -1,14 +1,18 @@
-from flask import Flask, request, jsonify
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import InfluxDBClient
 import json
-from datetime import datetime, timedelta
-import pytz
 from paho.mqtt.client import Client
 import os
+import sys
+import threading
 import logging
 import logging.config
 from dotenv import load_dotenv
+from InfluxBatchWriter import InfluxBatchWriter
+from measurements import station_point, convert_entities
+
+# The live heatmap lives in the interpolation package next to this one
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "interpolation"))
+from LiveHeatmap import live_heatmap_from_env, save_forever
 
 load_dotenv()
 
@@ -20,45 +24,39 @@ token = os.getenv('GRAFANA_READ_AND_WRITE')
 org = 'students'
 bucket = 'APARS'
 client = InfluxDBClient(url=os.getenv("INFLUX_URL"), token=token, org=org)
-write_api = client.write_api(write_options=SYNCHRONOUS)
+writer = InfluxBatchWriter(client, bucket, org, logger=logger)
 
 MQTT_BROKER = os.getenv("MQTT_ADDRESS")
 MQTT_PORT = int(os.getenv("MQTT_PORT"))
 MQTT_TOPIC = "station"
 
+LIVE_HEATMAP_FILE = os.path.join(os.getenv("LIVE_HEATMAP_DIR", "."), "live_heatmap_station.npz")
+# Seconds between two saves of the live heatmap, done by its own thread
+LIVE_HEATMAP_SAVE_INTERVAL = float(os.getenv("LIVE_HEATMAP_SAVE_INTERVAL", 30))
+
+# Built by start_mqtt, stays None when the bbox is not configured or the grid does not fit
+live_heatmap = None
 
-def toUTC(timestamp):
-    if timestamp.endswith("Z"):
-        utc_time = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-        adjusted_time = utc_time - timedelta(hours=2)
-        return adjusted_time.isoformat(timespec='microseconds')
-    else:
-        local_time = datetime.fromisoformat(timestamp)
-        utc_plus_2 = pytz.timezone('Europe/Athens')
-        localized_time = utc_plus_2.localize(local_time)
-        utc_time = localized_time.astimezone(pytz.utc)
-        return utc_time.replace(tzinfo=None).isoformat(timespec='microseconds')
 
 def send_to_influxdb(data):
     try:
-        payload = data["data"][0]
-
-        print(f"AAAAAAAAAAA\n{toUTC(payload['dateObserved']['value'])}")
-
-        point = Point('station_aqi') \
-                .tag("id", str(payload['id'])) \
-                .field("aqi", int(payload['aqi']['value'])) \
-                .time(toUTC(payload['dateObserved']['value'])) \
-                .field("latitude", float(payload['location']['value']['coordinates'][0])) \
-                .field("longitude", float(payload['location']['value']['coordinates'][1]))
-        
-
-        write_api.write(bucket=bucket, org=org, record=point)
-        
-        logger.info(f"Data for ID '{payload['id']}' successfully written to InfluxDB under measurement 'station_aqi'.")
+        results, errors = convert_entities(data["data"], station_point)
+        for entity_id, e in errors:
+            logger.error(f"Failed to convert data for ID '{entity_id}': {str(e)}")
+
+        if results:
+            writer.write([point for point, _ in results])
+            logger.info(f"Data for {len(results)} ID(s) queued for InfluxDB under measurement 'station_aqi'.")
+
+        if live_heatmap is None:
+            return
+        added = sum(live_heatmap.add(*reading) for _, reading in results)
+        if added < len(results):
+            logger.warning(f"{len(results) - added} of {len(results)} reading(s) were outside the live heatmap "
+                           f"or too old for it ({live_heatmap.rejected})")
         
     except Exception as e:
-        logger.error(f"Failed to write data to InfluxDB: {str(e)}")
+        logger.error(f"Failed to queue data for InfluxDB: {str(e)}")
 
 
 def on_connect(client, userdata, flags, rc):
@@ -78,11 +76,27 @@ def on_message(client, userdata, msg):
         
 
 def start_mqtt():
+    global live_heatmap
     mqtt_client = Client()
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
     mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-    mqtt_client.loop_forever() 
+    writer.start()
+    live_heatmap = live_heatmap_from_env(logger)
+    stop = threading.Event()
+    saver = None
+    if live_heatmap is not None:
+        saver = threading.Thread(target=save_forever, args=(live_heatmap, LIVE_HEATMAP_FILE, stop),
+                                 kwargs={"interval": LIVE_HEATMAP_SAVE_INTERVAL, "logger": logger},
+                                 name="live-heatmap-saver", daemon=True)
+        saver.start()
+    try:
+        mqtt_client.loop_forever()
+    finally:
+        stop.set()
+        if saver is not None:
+            saver.join()
+        writer.close()
 
 
 if __name__ == '__main__':
@@ -1,14 +1,12 @@
-from flask import Flask, request, jsonify
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import InfluxDBClient
 import json
-from datetime import datetime, timedelta
-import pytz
 from paho.mqtt.client import Client
 import os
 import logging
 import logging.config
 from dotenv import load_dotenv
+from InfluxBatchWriter import InfluxBatchWriter
+from measurements import metrics_point, convert_entities
 
 load_dotenv()
 
@@ -20,7 +18,7 @@ token = os.getenv('GRAFANA_READ_AND_WRITE')
 org = 'students'
 bucket = 'APARS'
 client = InfluxDBClient(url=os.getenv("INFLUX_URL"), token=token, org=org)
-write_api = client.write_api(write_options=SYNCHRONOUS)
+writer = InfluxBatchWriter(client, bucket, org, logger=logger)
 
 MQTT_BROKER = os.getenv("MQTT_ADDRESS")
 MQTT_PORT = int(os.getenv("MQTT_PORT"))
@@ -31,40 +29,18 @@ MQTT_TOPICS = {
 }
 
 
-def toUTC(timestamp):
-    if timestamp.endswith("Z"):
-        utc_time = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-        adjusted_time = utc_time - timedelta(hours=2)
-        return adjusted_time.isoformat(timespec='microseconds')
-    else:
-        local_time = datetime.fromisoformat(timestamp)
-        utc_plus_2 = pytz.timezone('Europe/Athens')
-        localized_time = utc_plus_2.localize(local_time)
-        utc_time = localized_time.astimezone(pytz.utc)
-        return utc_time.replace(tzinfo=None).isoformat(timespec='microseconds')
-
 def send_to_influxdb(data, measurement_type):
     try:
-        payload = data["data"][0]
-
-        point = Point(measurement_type) \
-                .tag("id", str(payload['id'])) \
-                .field("pm1", float(payload['pm1']['value'])) \
-                .field("pm25", float(payload['pm25']['value'])) \
-                .field("pm10", float(payload['pm10']['value'])) \
-                .field("co", float(payload['co']['value'])) \
-                .field("co2", float(payload['co2']['value'])) \
-                .time(toUTC(payload['dateObserved']['value'])) \
-                .field("latitude", float(payload['location']['value']['coordinates'][0])) \
-                .field("longitude", float(payload['location']['value']['coordinates'][1]))
-        
+        points, errors = convert_entities(data["data"], lambda payload: metrics_point(payload, measurement_type))
+        for entity_id, e in errors:
+            logger.error(f"Failed to convert data for ID '{entity_id}': {str(e)}")
 
-        write_api.write(bucket=bucket, org=org, record=point)
-        
-        logger.info(f"Data for ID '{payload['id']}' successfully written to InfluxDB under measurement '{measurement_type}'.")
+        if points:
+            writer.write(points)
+            logger.info(f"Data for {len(points)} ID(s) queued for InfluxDB under measurement '{measurement_type}'.")
         
     except Exception as e:
-        logger.error(f"Failed to write data to InfluxDB: {str(e)}")
+        logger.error(f"Failed to queue data for InfluxDB: {str(e)}")
 
 
 def on_connect(client, userdata, flags, rc):
@@ -94,7 +70,11 @@ def start_mqtt():
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
     mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-    mqtt_client.loop_forever() 
+    writer.start()
+    try:
+        mqtt_client.loop_forever()
+    finally:
+        writer.close()
 
 
 if __name__ == '__main__':
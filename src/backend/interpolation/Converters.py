@@ -1,9 +1,115 @@
 import numpy as np
+from bisect import bisect_right
 from ProgressBar import ProgressBar
 import netCDF4 as nc
-from MathFunctions import Calculations, Validations
+from MathFunctions import Validations
+from grid_engine import grid_axes, build_grid
 from datetime import datetime
 
+# AQI range of every breakpoint category, shared by all parameters
+AQI_RANGES = [
+    (0, 50),
+    (51, 100),
+    (101, 150),
+    (151, 200),
+    (201, 300),
+    (301, 500),
+]
+
+# Concentration breakpoints per parameter, see Converters.getAQI for the sources
+AQI_BREAKPOINTS = {
+    "pm1": [
+        (0, 9), 
+        (9.1, 35.4), 
+        (35.5, 55.4), 
+        (55.5, 125.4), 
+        (125.5, 225.4), 
+        (225.5, 500)
+        ],
+    "pm25": [
+        (0, 9), 
+        (9.1, 35.4), 
+        (35.5, 55.4), 
+        (55.5, 125.4), 
+        (125.5, 225.4), 
+        (225.5, 500)
+        ],
+    "pm10": [
+        (0, 54), 
+        (54.1, 154), 
+        (154.1, 254), 
+        (254.1, 354), 
+        (354.1, 424), 
+        (424.1, 604)
+        ],
+    "nh3": [
+        (0, 200), 
+        (200.1, 400), 
+        (400.1, 800), 
+        (800.1, 1200), 
+        (1200.1, 1800), 
+        (1800.1, 2400)
+        ],
+    "oxidized": [
+        (0, 100), 
+        (100.1, 200), 
+        (200.1, 300), 
+        (300.1, 400), 
+        (400.1, 500), 
+        (500.1, 600)
+        ],
+    "reduced": [
+        (0, 100), 
+        (100.1, 200), 
+        (200.1, 300), 
+        (300.1, 400), 
+        (400.1, 500), 
+        (500.1, 600)
+        ],
+    "co2": [
+        (0, 350), 
+        (350.1, 600), 
+        (600.1, 1000), 
+        (1000.1, 1500), 
+        (1500.1, 2000), 
+        (2000.1, 5000)
+        ],
+    "co": [
+        (0.0, 4.4),
+        (4.5, 9.4),
+        (9.5, 12.4),
+        (12.5, 15.4),
+        (15.5, 30.4),
+        (30.5, 50.4),
+    ],
+    "dust": [
+        (0, 54), 
+        (54.1, 154), 
+        (154.1, 254), 
+        (254.1, 354), 
+        (354.1, 424), 
+        (424.1, 604)
+        ],
+}
+
+# Per parameter lookup tables built once at import:
+# (low breakpoints, high breakpoints, low AQIs, slopes) as NumPy arrays.
+# The slope is the same ((high_aqi - low_aqi) / (high_bp - low_bp)) getAQI used
+# to compute on every call, so results are unchanged.
+AQI_TABLES = {
+    parameter: tuple(
+        np.array(column, dtype=float)
+        for column in zip(*[
+            (low_bp, high_bp, low_aqi, (high_aqi - low_aqi) / (high_bp - low_bp))
+            for (low_bp, high_bp), (low_aqi, high_aqi) in zip(bps, AQI_RANGES)
+        ])
+    )
+    for parameter, bps in AQI_BREAKPOINTS.items()
+}
+
+# The same tables as Python lists, faster than NumPy for one scalar at a time
+_AQI_SCALAR_TABLES = {parameter: tuple(column.tolist() for column in table) for parameter, table in AQI_TABLES.items()}
+
 class Converters:
     def __init__(self):
         pass
@@ -46,102 +152,48 @@ class Converters:
         The compiled data can be used for environmental monitoring, public awareness, and policymaking. It is especially useful for projects requiring a detailed understanding of pollutant behavior and their health impacts, such as the development of live AQI monitoring systems.
         """
 
-        aqi_ranges = [
-            (0, 50),
-            (51, 100),
-            (101, 150),
-            (151, 200),
-            (201, 300),
-            (301, 500),
-        ]
-
-        breakpoints = {
-            "pm1": [
-                (0, 9), 
-                (9.1, 35.4), 
-                (35.5, 55.4), 
-                (55.5, 125.4), 
-                (125.5, 225.4), 
-                (225.5, 500)
-                ],
-            "pm25": [
-                (0, 9), 
-                (9.1, 35.4), 
-                (35.5, 55.4), 
-                (55.5, 125.4), 
-                (125.5, 225.4), 
-                (225.5, 500)
-                ],
-            "pm10": [
-                (0, 54), 
-                (54.1, 154), 
-                (154.1, 254), 
-                (254.1, 354), 
-                (354.1, 424), 
-                (424.1, 604)
-                ],
-            "nh3": [
-                (0, 200), 
-                (200.1, 400), 
-                (400.1, 800), 
-                (800.1, 1200), 
-                (1200.1, 1800), 
-                (1800.1, 2400)
-                ],
-            "oxidized": [
-                (0, 100), 
-                (100.1, 200), 
-                (200.1, 300), 
-                (300.1, 400), 
-                (400.1, 500), 
-                (500.1, 600)
-                ],
-            "reduced": [
-                (0, 100), 
-                (100.1, 200), 
-                (200.1, 300), 
-                (300.1, 400), 
-                (400.1, 500), 
-                (500.1, 600)
-                ],
-            "co2": [
-                (0, 350), 
-                (350.1, 600), 
-                (600.1, 1000), 
-                (1000.1, 1500), 
-                (1500.1, 2000), 
-                (2000.1, 5000)
-                ],
-            "co": [
-                (0.0, 4.4),
-                (4.5, 9.4),
-                (9.5, 12.4),
-                (12.5, 15.4),
-                (15.5, 30.4),
-                (30.5, 50.4),
-            ],
-            "dust": [
-                (0, 54), 
-                (54.1, 154), 
-                (154.1, 254), 
-                (254.1, 354), 
-                (354.1, 424), 
-                (424.1, 604)
-                ],
-        }
-
-        if parameter not in breakpoints:
+        if parameter not in _AQI_SCALAR_TABLES:
             raise ValueError(f"Unknown parameter: {parameter}")
 
-        for (low_bp, high_bp), (low_aqi, high_aqi) in zip(breakpoints[parameter], aqi_ranges):
-            if low_bp <= value <= high_bp:
-                aqi = ((high_aqi - low_aqi) / (high_bp - low_bp)) * (value - low_bp) + low_aqi
-                return int(round(aqi))
+        lows, highs, low_aqis, slopes = _AQI_SCALAR_TABLES[parameter]
+        k = bisect_right(lows, value) - 1
+        if k >= 0 and value <= highs[k]:
+            aqi = slopes[k] * (value - lows[k]) + low_aqis[k]
+            return int(round(aqi))
 
         return None
 
 
-    def points_to_grid(self, points: list, west: float, east: float, south: float, north: float, resolution: float=0.001, influence_radius_km: float=0.01, base_value: int=10):
+    def getAQIBatch(self, parameter: str, values, fill: float = np.nan) -> np.ndarray:
+        """
+        Array version of getAQI for whole arrays of concentrations of one parameter.
+
+        Args:
+            parameter (str): The name of the parameter (e.g., 'pm25', 'co2').
+            values (array-like): The measured values, any shape.
+            fill (float): Result where getAQI would return None, i.e. for values
+                outside every breakpoint range (negative, above the last
+                breakpoint, in a gap between two ranges, or NaN).
+
+        Returns:
+            np.ndarray: Float array of the rounded AQI values, same shape as values.
+        """
+        if parameter not in AQI_TABLES:
+            raise ValueError(f"Unknown parameter: {parameter}")
+
+        lows, highs, low_aqis, slopes = AQI_TABLES[parameter]
+        values = np.asarray(values, dtype=float)
+
+        k = np.searchsorted(lows, values, side="right") - 1
+        safe_k = np.clip(k, 0, len(lows) - 1)
+        inside = (k >= 0) & (values <= highs[safe_k])
+
+        # np.round rounds half to even, like the built-in round in getAQI
+        aqi = np.round(slopes[safe_k] * (values - lows[safe_k]) + low_aqis[safe_k])
+        return np.where(inside, aqi, fill)
+
+
+    def points_to_grid(self, points: list, west: float, east: float, south: float, north: float, resolution: float=0.001, influence_radius_km: float=0.01, base_value: int=10, method: str="splat", workers: int=1, dtype=float, grid_file: str=None, base_grid=None):
         '''
         For the points parameter you need to map each point to the following SmartDataModel:
 
@@ -168,16 +220,14 @@ class Converters:
             }
         }  
 
+        A base_grid of the grid's shape (see SatelliteBaseLayer) replaces the
+        constant base_value as the background the points are splatted on.
+
         '''
 
         pb = ProgressBar()
 
-        lats = np.arange(south, north, resolution)
-        lons = np.arange(west, east, resolution*2)
-
-        lon_grid, lat_grid = np.meshgrid(lons, lats)
-
-        grid = np.full(lon_grid.shape, base_value, dtype=float)
+        lats, lons = grid_axes(west, east, south, north, resolution)
 
         clip_points = [
             {"lat": point["location"]["value"]["coordinates"][0], "lon": point["location"]["value"]["coordinates"][1], "value": int(point["aqi"]["value"] if Validations.isInt(point["aqi"]["value"]) == False else 40)}
@@ -185,17 +235,22 @@ class Converters:
             if south <= point["location"]["value"]["coordinates"][0] <= north and west <= point["location"]["value"]["coordinates"][1] <= east
         ]
 
-        for point in clip_points:
-            point_lat = point["lat"]
-            point_lon = point["lon"]
-            point_value = point["value"]
-            print(f"{clip_points.index(point)+1}/{len(clip_points)} stations  ")
-            for i in range(len(lats)):
-                pb.print(i+1, len(lats), prefix = 'Progress:', suffix = 'Complete', length = 50)
-                for j in range(len(lons)):
-                    distance = np.sqrt((lats[i] - point_lat)**2 + (lons[j] - point_lon)**2)
-                    decay = Calculations.radial_decay(distance, influence_radius_km)
-                    grid[i, j] += decay * (point_value - base_value)
+        print(f"{len(clip_points)} stations  ")
+        grid = build_grid(
+            lats, lons,
+            [point["lat"] for point in clip_points],
+            [point["lon"] for point in clip_points],
+            [point["value"] for point in clip_points],
+            influence_radius_km,
+            base_value=base_value,
+            method=method,
+            resolution=resolution,
+            workers=workers,
+            dtype=dtype,
+            file_name=grid_file,
+            progress=lambda done, total: pb.print(done, total, prefix = 'Progress:', suffix = 'Complete', length = 50),
+            base_grid=base_grid,
+        )
         
         return lats, lons, grid
 
@@ -0,0 +1,118 @@
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class HeatmapWriter:
+    """
+    Bulk writer for interpolated grids.
+
+    The lats/lons/grid arrays are turned straight into line protocol and sent
+    in large gzip-compressed batches through a bounded pool of concurrent
+    writes, each retried with exponential backoff, instead of one HTTP request
+    per cell.
+    """
+
+    def __init__(self, url: str, token: str, org: str, bucket: str, measurement: str = "heatmap",
+                 batch_size: int = 50000, max_in_flight: int = 4, retries: int = 3, backoff: float = 1.0,
+                 timeout_ms: int = 60000):
+        self.org = org
+        self.bucket = bucket
+        self.measurement = measurement
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+
+        self.client = InfluxDBClient(url=url, token=token, org=org, enable_gzip=True, timeout=timeout_ms)
+        self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+
+    @staticmethod
+    def to_nanoseconds(timestamp: str) -> int:
+        """
+        Converts a naive UTC ISO timestamp to epoch nanoseconds.
+        """
+        moment = datetime.fromisoformat(timestamp)
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return (moment - EPOCH) // timedelta(microseconds=1) * 1000
+
+    def lines(self, lats, lons, grid, timestamp_ns: int):
+        """
+        Yields the grid as batches of line protocol strings.
+
+        Every cell becomes "<measurement> aqi=..,lat=..,lon=.. <timestamp_ns>",
+        the same fields the per-cell Point writes had. Non finite cells are
+        skipped since line protocol cannot carry them.
+        """
+        lon_reprs = [repr(float(lon)) for lon in lons]
+        batch = []
+
+        for i, lat in enumerate(lats):
+            lat_repr = repr(float(lat))
+            row = np.asarray(grid[i], dtype=float)
+            finite = np.isfinite(row)
+            for j, value in enumerate(row.tolist()):
+                if finite[j]:
+                    batch.append(f"{self.measurement} aqi={value!r},lat={lat_repr},lon={lon_reprs[j]} {timestamp_ns}")
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def _write_batch(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                self.write_api.write(bucket=self.bucket, org=self.org, record=batch)
+                return len(batch)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def write_grid(self, lats, lons, grid, timestamp: str, progress=None) -> int:
+        """
+        Writes every cell of the grid with the given timestamp.
+
+        At most max_in_flight batches are generated ahead of the HTTP writes,
+        which bounds memory regardless of the grid size.
+
+        Args:
+            lats, lons, grid: Output of interpolate_points.
+            timestamp (str): Naive UTC ISO timestamp of the heatmap.
+            progress (callable): Optional progress(done_batches, total_batches) callback.
+
+        Returns:
+            int: Number of cells written.
+        """
+        timestamp_ns = self.to_nanoseconds(timestamp)
+        total_batches = max(1, math.ceil(len(lats) * len(lons) / self.batch_size))
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        futures = []
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            for done, batch in enumerate(self.lines(lats, lons, grid, timestamp_ns), start=1):
+                in_flight.acquire()
+                future = executor.submit(self._write_batch, batch)
+                future.add_done_callback(lambda _: in_flight.release())
+                futures.append(future)
+                if progress is not None and done < total_batches:
+                    progress(done, total_batches)
+
+        if progress is not None:
+            progress(total_batches, total_batches)
+        return sum(future.result() for future in futures)
+
+    def close(self):
+        self.write_api.close()
+        self.client.close()
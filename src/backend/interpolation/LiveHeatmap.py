@@ -0,0 +1,273 @@
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from grid_backend import allocate_grid, ensure_fits
+from grid_engine import grid_axes, splat_points
+
+# Snapshot files the car and station ingestion write into LIVE_HEATMAP_DIR
+LIVE_HEATMAP_FILES = ("live_heatmap_car.npz", "live_heatmap_station.npz")
+
+
+class LiveHeatmap:
+    """
+    Long-lived interpolation grid that is kept up to date reading by reading.
+
+    Every ingested reading adds its radial decay contribution to the grid and
+    the same contribution is subtracted once the reading falls out of the time
+    window, so the current map costs O(stamp) per message instead of a full
+    interpolate_points run per refresh.
+    """
+
+    def __init__(self, west: float, east: float, south: float, north: float, resolution: float = 0.001,
+                 base_value: float = 10, window_minutes: float = 10, rebuild_every: int = 10000):
+        self.west, self.east, self.south, self.north = west, east, south, north
+        self.resolution = resolution
+        self.base_value = base_value
+        self.window = timedelta(minutes=window_minutes)
+        self.rebuild_every = rebuild_every
+
+        self.lats, self.lons = grid_axes(west, east, south, north, resolution)
+        shape = (len(self.lats), len(self.lons))
+        # The grid plus the copy every save takes, MemoryError when they do not fit
+        ensure_fits(shape, float, copies=2)
+        self.grid = allocate_grid(shape, base_value, dtype=float)
+
+        # (expires_at, seq, latitude, longitude, value, radius) ordered by expiry
+        self._readings = []
+        self._seq = itertools.count()
+        self._removed_since_rebuild = 0
+        # Readings add() turned down, by reason
+        self.rejected = {"outside": 0, "expired": 0}
+        # Bumped on every change of the grid, so unchanged maps are not saved again
+        self._version = 0
+        self._saved_version = None
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def _splat(self, latitude, longitude, value, radius, sign):
+        # Splat the signed delta against a zero base, so removing a reading
+        # subtracts exactly the contribution that adding it produced.
+        splat_points(self.grid, self.lats, self.lons, [latitude], [longitude],
+                     [sign * (value - self.base_value)], [radius], base_value=0)
+
+    def add(self, latitude: float, longitude: float, value: float, radius: float, observed_at: datetime = None) -> bool:
+        """
+        Adds a reading to the grid.
+
+        Args:
+            latitude, longitude (float): Position of the reading.
+            value (float): AQI of the reading.
+            radius (float): Influence radius in degrees.
+            observed_at (datetime): Naive UTC observation time, defaults to now.
+
+        Returns:
+            bool: False when the reading is outside the bbox or already expired,
+            counted in rejected.
+        """
+        if not (self.south <= latitude <= self.north and self.west <= longitude <= self.east):
+            with self._lock:
+                self.rejected["outside"] += 1
+            return False
+
+        now = datetime.utcnow()
+        expires_at = (observed_at or now) + self.window
+        if expires_at <= now:
+            with self._lock:
+                self.rejected["expired"] += 1
+            return False
+
+        with self._lock:
+            self._version += 1
+            self._splat(latitude, longitude, value, radius, 1)
+            heapq.heappush(self._readings, (expires_at, next(self._seq), latitude, longitude, value, radius))
+            self._expire(now)
+        return True
+
+    def expire(self, now: datetime = None) -> int:
+        """
+        Subtracts every reading that left the time window.
+
+        Returns:
+            int: Number of readings removed.
+        """
+        with self._lock:
+            return self._expire(now or datetime.utcnow())
+
+    def _expire(self, now):
+        removed = 0
+        while self._readings and self._readings[0][0] <= now:
+            _, _, latitude, longitude, value, radius = heapq.heappop(self._readings)
+            self._splat(latitude, longitude, value, radius, -1)
+            removed += 1
+        if removed:
+            self._version += 1
+
+        self._removed_since_rebuild += removed
+        if self._removed_since_rebuild >= self.rebuild_every:
+            self._rebuild()
+        return removed
+
+    def rebuild(self):
+        """
+        Recomputes the grid from the readings still in the window, clearing the
+        floating point drift that repeated add/subtract pairs accumulate.
+        """
+        with self._lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        self.grid.fill(self.base_value)
+        if self._readings:
+            _, _, latitudes, longitudes, values, radii = zip(*sorted(self._readings, key=lambda r: r[1]))
+            splat_points(self.grid, self.lats, self.lons, latitudes, longitudes, values, radii,
+                         base_value=self.base_value)
+        self._removed_since_rebuild = 0
+
+    def __len__(self):
+        return len(self._readings)
+
+    def snapshot(self):
+        """
+        Returns a consistent (lats, lons, grid) copy of the current map.
+        """
+        with self._lock:
+            return self.lats, self.lons, self.grid.copy()
+
+    def save(self, file_name: str):
+        """
+        Expires the readings that left the window and writes the map to an
+        .npz file, replacing it atomically.
+
+        Saves are serialized, so concurrent callers never share the temp file.
+        """
+        with self._save_lock:
+            with self._lock:
+                self._expire(datetime.utcnow())
+                lats, lons, grid = self.lats, self.lons, self.grid.copy()
+                version = self._version
+            tmp_name = f"{file_name}.tmp.npz"
+            np.savez(tmp_name, lats=lats, lons=lons, grid=grid, base_value=self.base_value)
+            os.replace(tmp_name, file_name)
+            self._saved_version = version
+
+    def maybe_save(self, file_name: str) -> bool:
+        """
+        Expires old readings and saves the map if it changed since the last save.
+
+        Meant to be called periodically from one saver thread (see
+        save_forever), so no message handler pays for the grid copy and write.
+        """
+        if not file_name:
+            return False
+        self.expire()
+        if self._version == self._saved_version:
+            return False
+        self.save(file_name)
+        return True
+
+
+def live_heatmap_from_env(logger=None):
+    """
+    LiveHeatmap of the WEST/EAST/SOUTH/NORTH bbox at HEATMAP_RESOLUTION.
+
+    Returns:
+        LiveHeatmap | None: None, logged, when the bbox is not configured or
+        the grid does not fit in memory, so the service runs without a live map.
+    """
+    bounds = [os.getenv(name) for name in ("WEST", "EAST", "SOUTH", "NORTH")]
+    if not all(bounds):
+        if logger:
+            logger.warning("WEST/EAST/SOUTH/NORTH are not set, live heatmap disabled")
+        return None
+    try:
+        west, east, south, north = (float(bound) for bound in bounds)
+        return LiveHeatmap(west=west, east=east, south=south, north=north,
+                           resolution=float(os.getenv("HEATMAP_RESOLUTION", 0.001)))
+    except (ValueError, MemoryError) as e:
+        if logger:
+            logger.error(f"Live heatmap disabled: {str(e)}")
+        return None
+
+
+def save_forever(live_heatmap: LiveHeatmap, file_name: str, stop: threading.Event, interval: float = 30,
+                 logger=None):
+    """
+    Runs maybe_save every interval seconds until stop is set, then saves once more.
+
+    Expiry runs on this schedule too, so a snapshot never keeps readings past
+    the window when traffic stops.
+    """
+    while not stop.wait(interval):
+        try:
+            live_heatmap.maybe_save(file_name)
+        except Exception as e:
+            if logger:
+                logger.error(f"Failed to save live heatmap {file_name}: {str(e)}")
+    live_heatmap.save(file_name)
+
+
+def load_heatmap(*file_names):
+    """
+    Loads one or more LiveHeatmap snapshots of the same grid and merges them.
+
+    Every snapshot holds base_value plus its own readings, so the merged map is
+    base_value plus the sum of each snapshot's deltas.
+
+    Returns:
+        tuple: (lats, lons, grid)
+    """
+    lats = lons = grid = None
+    for file_name in file_names:
+        with np.load(file_name) as snapshot:
+            if grid is None:
+                lats, lons, grid = snapshot["lats"], snapshot["lons"], snapshot["grid"].copy()
+            else:
+                grid += snapshot["grid"] - float(snapshot["base_value"])
+    return lats, lons, grid
+
+
+def load_live_heatmap(directory, max_age: float = None):
+    """
+    Merges the live snapshots of directory (LIVE_HEATMAP_FILES) with load_heatmap.
+
+    Snapshots older than max_age seconds, left by a stopped service, are
+    ignored.
+
+    Returns:
+        tuple | None: (lats, lons, grid), None when there is no usable snapshot.
+    """
+    file_names = [
+        os.path.join(directory, file_name) for file_name in LIVE_HEATMAP_FILES
+        if os.path.exists(os.path.join(directory, file_name))
+    ]
+    if max_age is not None:
+        file_names = [file_name for file_name in file_names if time.time() - os.path.getmtime(file_name) <= max_age]
+    if not file_names:
+        return None
+    return load_heatmap(*file_names)
+
+
+def grid_cells(lats, lons, grid, base_value: float = 10, max_points: int = None):
+    """
+    Cells of a heatmap that readings moved away from base_value, as
+    {"latitude", "longitude", "aqi"} points.
+
+    When there are more than max_points of them only every n-th row and
+    column is kept, so a map widget gets a bounded number of points.
+    """
+    rows, cols = np.nonzero(np.abs(grid - base_value) > 1e-6)
+    if max_points and len(rows) > max_points:
+        step = math.ceil(math.sqrt(len(rows) / max_points))
+        keep = (rows % step == 0) & (cols % step == 0)
+        rows, cols = rows[keep], cols[keep]
+    return [
+        {"latitude": float(lats[r]), "longitude": float(lons[c]), "aqi": float(grid[r, c])}
+        for r, c in zip(rows.tolist(), cols.tolist())
+    ]
@@ -0,0 +1,74 @@
+import threading
+import time
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """
+    Thread-safe TTL cache with request coalescing (single-flight).
+
+    Concurrent get_or_compute calls for the same key share one computation:
+    the first caller computes, the others wait for its result instead of
+    repeating the work. Results expire ttl_seconds after they were computed.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int = 32):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = {}  # key -> (expires_at, value)
+        self._flights = {}  # key -> _Flight
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, computing it with compute() if needed.
+
+        Exceptions raised by compute() are passed to every waiting caller and
+        nothing is cached, so the next request retries.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None:
+                    self._store(key, flight.value)
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.value
+
+    def _store(self, key, value):
+        now = time.monotonic()
+        self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+        while len(self._entries) >= self.max_entries:
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (now + self.ttl_seconds, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,234 @@
+# Background AQI field for the interpolation grid, derived from the CAMS
+# netCDF files the satellite accumulator downloads.
+#
+# Usage:
+#   python SatelliteBaseLayer.py satellite_accumulated/*.nc --output base_layer.npz
+#
+# With the accumulators' docker compose the files land on the host in
+# src/data_sources/accumulators/satellite/satellite_accumulated, the
+# directory to give grid_interpolation as CAMS_DIR.
+
+import argparse
+import os
+
+import netCDF4 as nc
+import numpy as np
+
+from Converters import Converters
+from grid_backend import chunk_rows
+from grid_engine import grid_axes
+
+# CAMS variable -> (AQI parameter of Converters, factor from the CAMS µg/m³ to the breakpoint unit)
+CAMS_AQI_PARAMETERS = {
+    "pm2p5_conc": ("pm25", 1.0),
+    "pm10_conc": ("pm10", 1.0),
+    "dust": ("dust", 1.0),
+    # Breakpoints are in ppm: ppm = µg/m³ * 24.45 / (molar mass * 1000)
+    "co_conc": ("co", 24.45 / (28.01 * 1000)),
+}
+
+# (source axis signature, target axis signature) -> (low index, high index, fraction)
+_axis_weights = {}
+
+
+def _bbox_slice(axis, low, high):
+    """
+    Indices of axis covering [low, high] plus one neighbour on each side,
+    so every target cell inside the bbox has source cells around it.
+
+    As in the satellite accumulator's bbox_index_ranges, a contiguous range
+    is a slice (read as one hyperslab) and anything else a boolean mask. The
+    margin is the median grid step, so the single 360 degree jump of a
+    wrapped longitude axis does not widen it to the whole axis.
+    """
+    step = float(np.median(np.abs(np.diff(axis)))) if len(axis) > 1 else 0.0
+    inside = (axis >= low - step) & (axis <= high + step)
+    indices = np.flatnonzero(inside)
+    if indices.size == 0:
+        return slice(0, 0)
+    start, stop = int(indices[0]), int(indices[-1]) + 1
+    if stop - start != indices.size:
+        return inside
+    return slice(start, stop)
+
+
+def _normalize_longitudes(lons):
+    """
+    Longitudes in [-180, 180), the convention of the bbox, for 0-360 CAMS grids.
+    """
+    return (lons + 180.0) % 360.0 - 180.0
+
+
+def cams_aqi_raster(nc_files, west, east, south, north):
+    """
+    Reads the CAMS pollutants of the bbox and converts them to one AQI raster.
+
+    Every pollutant of CAMS_AQI_PARAMETERS found in the files is converted
+    with Converters.getAQIBatch and the raster keeps the highest AQI of each
+    cell, as the car webhook does for its readings. Only the latest time step
+    and the first level are used. Cells without any valid value are NaN.
+
+    Returns:
+        tuple: (ascending lats, ascending lons, AQI raster)
+    """
+    converter = Converters()
+    lats = lons = raster = None
+
+    for nc_file in nc_files:
+        with nc.Dataset(nc_file, mode="r") as ds:
+            file_lats = np.asarray(ds.variables["latitude"][:], dtype=float)
+            file_lons = _normalize_longitudes(np.asarray(ds.variables["longitude"][:], dtype=float))
+            lat_slice = _bbox_slice(file_lats, south, north)
+            lon_slice = _bbox_slice(file_lons, west, east)
+
+            for name, (parameter, factor) in CAMS_AQI_PARAMETERS.items():
+                if name not in ds.variables:
+                    continue
+                variable = ds.variables[name]
+                # Latest step of the time dimensions (time, valid_time, ...), first index of the others (level)
+                slices = [-1 if "time" in dimension else 0 for dimension in variable.dimensions]
+                slices[variable.dimensions.index("latitude")] = lat_slice
+                slices[variable.dimensions.index("longitude")] = lon_slice
+                values = np.ma.filled(np.ma.asarray(variable[tuple(slices)], dtype=float), np.nan)
+                if variable.dimensions.index("latitude") > variable.dimensions.index("longitude"):
+                    values = values.T
+
+                aqi = converter.getAQIBatch(parameter, values * factor)
+                if raster is None:
+                    lats, lons, raster = file_lats[lat_slice], file_lons[lon_slice], aqi
+                elif aqi.shape == raster.shape:
+                    raster = np.fmax(raster, aqi)
+                else:
+                    raise ValueError(f"{nc_file} is not on the grid of the other CAMS files")
+
+    if raster is None:
+        raise ValueError(f"No CAMS variable of {list(CAMS_AQI_PARAMETERS)} found in {list(nc_files)}")
+
+    # Descending or wrapped axes are reordered to the ascending ones np.interp needs
+    lat_order = np.argsort(lats, kind="stable")
+    lon_order = np.argsort(lons, kind="stable")
+    return lats[lat_order], lons[lon_order], raster[lat_order][:, lon_order]
+
+
+def bilinear_axis_weights(source, target):
+    """
+    Per target coordinate: the two surrounding source indices and the
+    fraction towards the second, clamped to the source edges.
+
+    Cached per (source, target) axis pair, so hourly runs on the same CAMS
+    grid and interpolation grid compute them once.
+    """
+    key = (len(source), float(source[0]), float(source[-1]), len(target), float(target[0]), float(target[-1]))
+    if key not in _axis_weights:
+        position = np.interp(target, source, np.arange(len(source), dtype=float))
+        low = np.clip(np.floor(position).astype(np.intp), 0, max(len(source) - 2, 0))
+        high = np.minimum(low + 1, len(source) - 1)
+        _axis_weights[key] = (low, high, position - low)
+    return _axis_weights[key]
+
+
+def resample_bilinear(raster, lats, lons, target_lats, target_lons, fill=10, dtype=float):
+    """
+    Bilinearly resamples a raster on ascending axes onto the target axes.
+
+    The result is computed in row chunks (grid_backend.chunk_rows) so no
+    full size temporaries are created. Target cells touching a NaN source
+    cell get fill.
+    """
+    lat_low, lat_high, lat_fraction = bilinear_axis_weights(lats, target_lats)
+    lon_low, lon_high, lon_fraction = bilinear_axis_weights(lons, target_lons)
+
+    shape = (len(target_lats), len(target_lons))
+    grid = np.empty(shape, dtype=dtype)
+    rows = chunk_rows(shape, dtype)
+
+    for r0 in range(0, shape[0], rows):
+        r1 = min(r0 + rows, shape[0])
+        below, above = raster[lat_low[r0:r1]], raster[lat_high[r0:r1]]
+        bottom = below[:, lon_low] * (1 - lon_fraction) + below[:, lon_high] * lon_fraction
+        top = above[:, lon_low] * (1 - lon_fraction) + above[:, lon_high] * lon_fraction
+        fraction = lat_fraction[r0:r1, None]
+        block = bottom * (1 - fraction) + top * fraction
+        grid[r0:r1] = np.where(np.isnan(block), fill, block)
+
+    return grid
+
+
+def build_base_layer(nc_files, west, east, south, north, resolution=0.001, file_name=None, base_value=10,
+                     dtype=float):
+    """
+    CAMS AQI resampled onto the interpolation grid of the bbox.
+
+    Cells without satellite data get base_value. When file_name is given the
+    layer is saved there as an .npz (lats, lons, grid, base_value), replacing
+    the previous one atomically.
+
+    Returns:
+        tuple: (lats, lons, grid)
+    """
+    raster_lats, raster_lons, raster = cams_aqi_raster(nc_files, west, east, south, north)
+    lats, lons = grid_axes(west, east, south, north, resolution)
+    grid = resample_bilinear(raster, raster_lats, raster_lons, lats, lons, fill=base_value, dtype=dtype)
+
+    if file_name is not None:
+        tmp_name = f"{file_name}.tmp.npz"
+        np.savez(tmp_name, lats=lats, lons=lons, grid=grid, base_value=base_value)
+        os.replace(tmp_name, file_name)
+    return lats, lons, grid
+
+
+def load_base_layer(file_name, lats=None, lons=None):
+    """
+    Loads a saved base layer.
+
+    When lats and lons are given the layer must be on exactly that grid,
+    otherwise None is returned and the caller falls back to a constant base.
+    """
+    if not file_name or not os.path.exists(file_name):
+        return None
+    with np.load(file_name) as layer:
+        if lats is not None and not np.array_equal(layer["lats"], lats):
+            return None
+        if lons is not None and not np.array_equal(layer["lons"], lons):
+            return None
+        return layer["grid"]
+
+
+def ensure_base_layer(nc_files, west, east, south, north, resolution=0.001, file_name=None, base_value=10):
+    """
+    Returns the saved base layer, rebuilding it first when it is missing,
+    older than the newest CAMS file or on another grid.
+
+    Returns:
+        np.ndarray | None: The layer, None when there are no CAMS files.
+    """
+    lats, lons = grid_axes(west, east, south, north, resolution)
+    if not nc_files:
+        return load_base_layer(file_name, lats, lons)
+
+    newest = max(os.path.getmtime(nc_file) for nc_file in nc_files)
+    if file_name is not None and os.path.exists(file_name) and os.path.getmtime(file_name) >= newest:
+        grid = load_base_layer(file_name, lats, lons)
+        if grid is not None:
+            return grid
+
+    return build_base_layer(nc_files, west, east, south, north, resolution, file_name, base_value)[2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the satellite AQI base layer of the interpolation grid.")
+    parser.add_argument("nc_files", nargs="+", help="CAMS netCDF files")
+    parser.add_argument("--output", default=os.getenv("BASE_LAYER_FILE", "base_layer.npz"))
+    parser.add_argument("--resolution", type=float, default=0.001)
+    args = parser.parse_args()
+
+    lats, lons, grid = build_base_layer(
+        args.nc_files,
+        west=float(os.getenv("WEST")),
+        east=float(os.getenv("EAST")),
+        south=float(os.getenv("SOUTH")),
+        north=float(os.getenv("NORTH")),
+        resolution=args.resolution,
+        file_name=args.output,
+    )
+    print(f"Base layer {grid.shape[0]}x{grid.shape[1]} saved to {args.output} (AQI {np.nanmin(grid):.0f}-{np.nanmax(grid):.0f})")
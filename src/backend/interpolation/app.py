@@ -1,12 +1,16 @@
-from flask import Flask, render_template_string
+from flask import Flask, Response, render_template_string, request
 from ipyleaflet import Map, Heatmap
 from datetime import datetime, timedelta
 import pytz
 import numpy as np
 from influxdb_client import InfluxDBClient
 import os
+import time
+import hashlib
 from dotenv import load_dotenv
 from MathFunctions import Validations
+from ResultCache import ResultCache
+from LiveHeatmap import load_live_heatmap, grid_cells
 
 # Load environment variables
 load_dotenv()
@@ -20,6 +24,16 @@ client = InfluxDBClient(url=os.getenv("INFLUX_URL"), token=token, org=org)
 # Flask app setup
 app = Flask(__name__)
 
+# Heatmap data window and cache settings
+HEATMAP_WINDOW_MINUTES = 10
+HEATMAP_CACHE_TTL = int(os.getenv("HEATMAP_CACHE_TTL", 30))  # seconds, also the time bucket size
+
+heatmap_cache = ResultCache(ttl_seconds=HEATMAP_CACHE_TTL)
+
+# Snapshots written by the ingestion service, and the most grid cells the map gets from them
+LIVE_HEATMAP_DIR = os.getenv("LIVE_HEATMAP_DIR", ".")
+LIVE_HEATMAP_MAX_POINTS = int(os.getenv("LIVE_HEATMAP_MAX_POINTS", 20000))
+
 # Query InfluxDB data
 def query_influxdb(bucket, measurement, fields, last_n_minutes):
     try:
@@ -101,14 +115,25 @@ def create_heatmap(data):
     m.add_layer(heatmap)
     return m
 
-@app.route("/")
-def display_map():
-    # Query data from cars and stations
-    car_data = query_influxdb(BUCKET, "car_metrics", ["aqi", "latitude", "longitude"], 10)
-    station_data = query_influxdb(BUCKET, "station_aqi", ["aqi", "latitude", "longitude"], 10)
+# Heatmap points of the last minutes
+def heatmap_data(last_n_minutes):
+    # The live snapshot already holds the window, a snapshot older than it only has expired readings
+    live = load_live_heatmap(LIVE_HEATMAP_DIR, max_age=last_n_minutes * 60)
+    if live is not None:
+        return grid_cells(*live, max_points=LIVE_HEATMAP_MAX_POINTS)
+
+    # No live snapshot, query data from cars and stations
+    car_data = query_influxdb(BUCKET, "car_metrics", ["aqi", "latitude", "longitude"], last_n_minutes)
+    station_data = query_influxdb(BUCKET, "station_aqi", ["aqi", "latitude", "longitude"], last_n_minutes)
+    return car_data + station_data
 
-    # Combine data
-    combined_data = car_data + station_data
+def render_heatmap_page(last_n_minutes):
+    combined_data = heatmap_data(last_n_minutes)
+
+    # The widget HTML carries random ids, so the ETag is derived from the data
+    etag = hashlib.sha1(
+        repr([(d["latitude"], d["longitude"], d["aqi"]) for d in combined_data]).encode()
+    ).hexdigest()
 
     # Create the heatmap
     map_widget = create_heatmap(combined_data)
@@ -117,7 +142,7 @@ def display_map():
     map_html = map_widget._repr_html_()
 
     # Render map in Flask
-    return render_template_string(
+    page = render_template_string(
         """
         <!DOCTYPE html>
         <html lang="en">
@@ -134,6 +159,24 @@ def display_map():
         """,
         map_html=map_html
     )
+    return page, etag
+
+@app.route("/")
+def display_map():
+    # Requests in the same time bucket share one query and render
+    time_bucket = int(time.time() // HEATMAP_CACHE_TTL)
+    page, etag = heatmap_cache.get_or_compute(
+        (HEATMAP_WINDOW_MINUTES, time_bucket),
+        lambda: render_heatmap_page(HEATMAP_WINDOW_MINUTES)
+    )
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(page, mimetype="text/html")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"public, max-age={HEATMAP_CACHE_TTL}"
+    return response
 
 if __name__ == "__main__":
     app.run(debug=True)
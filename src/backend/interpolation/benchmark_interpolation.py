@@ -0,0 +1,262 @@
+# Benchmarks for the interpolation paths on seeded synthetic fleets.
+#
+# Every optimized path is checked against a golden reference grid before its
+# timings are reported, so a speedup can never silently change the output:
+# exact methods must match the reference bit for bit, approximate ones
+# ("stamp", float32) report their maximum deviation.
+#
+# Usage:
+#   python benchmark_interpolation.py
+#   python benchmark_interpolation.py --points 10,1000,100000 --cases patras,greece_coarse --methods splat,tiles
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from Converters import Converters
+from grid_engine import grid_axes, accumulate_points, build_grid
+
+# (west, east, south, north, resolution)
+CASES = {
+    "patras": (21.70, 21.82, 38.20, 38.30, 0.001),
+    "attica": (23.55, 24.05, 37.80, 38.15, 0.001),
+    "greece_coarse": (19.3646, 29.6425, 34.8021, 41.7489, 0.01),
+    "greece": (19.3646, 29.6425, 34.8021, 41.7489, 0.001),
+}
+
+# Cities the synthetic WAQI station layout is clustered around
+STATION_CITIES = [
+    (37.9838, 23.7275), (40.6401, 22.9444), (38.2466, 21.7346), (35.3387, 25.1442),
+    (39.6650, 20.8537), (39.3622, 22.9420), (40.8457, 25.8739), (41.1171, 20.8016),
+]
+
+# Mean and spread of a car's pollution profile, as in CarDataFaker.generate_pollution_profile
+CAR_PROFILE = {"pm1": (9, 10), "pm25": (15, 20), "pm10": (60, 30)}
+
+CAR_RADIUS = 0.01
+STATION_RADIUS = 0.02
+
+# Largest points x cells product checked against the pure Python loops
+PURE_PYTHON_LIMIT = 2_000_000
+# Largest points x cells product checked against the dense NumPy engine
+DENSE_LIMIT = 5_000_000_000
+
+
+def synthetic_fleet(n_points, west, east, south, north, seed=0):
+    """
+    Seeded cars and stations inside the bbox, in interpolate_points format.
+
+    Cars get an AQI from a CarDataFaker-like pollution profile, stations are
+    scattered around the biggest cities (or uniformly when none is inside).
+    """
+    rng = np.random.default_rng(seed)
+    converter = Converters()
+    n_stations = max(1, n_points // 10)
+    n_cars = n_points - n_stations
+
+    cars = []
+    for lat, lon in zip(rng.uniform(south, north, n_cars), rng.uniform(west, east, n_cars)):
+        aqi = 0
+        for param, (loc, scale) in CAR_PROFILE.items():
+            value = converter.getAQI(param, round(abs(rng.normal(loc, scale)), 2))
+            aqi = max(aqi, value if value is not None else 10)
+        cars.append({"latitude": float(lat), "longitude": float(lon), "aqi": aqi})
+
+    cities = [c for c in STATION_CITIES if south <= c[0] <= north and west <= c[1] <= east]
+    stations = []
+    for k in range(n_stations):
+        if cities:
+            city = cities[k % len(cities)]
+            lat = float(np.clip(rng.normal(city[0], 0.05), south, north))
+            lon = float(np.clip(rng.normal(city[1], 0.05), west, east))
+        else:
+            lat, lon = float(rng.uniform(south, north)), float(rng.uniform(west, east))
+        stations.append({"latitude": lat, "longitude": lon, "aqi": int(abs(rng.normal(45, 20)))})
+
+    return cars, stations
+
+
+def to_smart_data_models(point_set):
+    """
+    Maps points to the AirQualityObserved layout points_to_grid expects.
+    """
+    return [
+        {
+            "id": f"point_{k}",
+            "type": "AirQualityObserved",
+            "aqi": {"type": "Integer", "value": p["aqi"]},
+            "location": {"type": "geo:json", "value": {"type": "Point", "coordinates": [p["latitude"], p["longitude"]]}},
+        }
+        for k, p in enumerate(point_set)
+    ]
+
+
+def reference_grid(point_lats, point_lons, values, radii, west, east, south, north, resolution, base_value=10):
+    """
+    Golden grid: pure Python loops for small cases, the dense engine (itself
+    identical to the loops) when the loops would take too long.
+    """
+    lats, lons = grid_axes(west, east, south, north, resolution)
+    grid = np.full((len(lats), len(lons)), base_value, dtype=float)
+    work = len(values) * grid.size
+
+    if work <= PURE_PYTHON_LIMIT:
+        for plat, plon, value, radius in zip(point_lats, point_lons, values, radii):
+            for i, lat in enumerate(lats):
+                for j, lon in enumerate(lons):
+                    distance = np.sqrt((lat - plat) ** 2 + (lon - plon) ** 2)
+                    decay = 0 if distance > radius else 1 - (distance / radius)
+                    grid[i, j] += decay * (value - base_value)
+        return grid, "pure-python"
+
+    if work <= DENSE_LIMIT:
+        accumulate_points(grid, lats, lons, point_lats, point_lons, values, radii, base_value=base_value)
+        return grid, "dense"
+
+    return None, "skipped"
+
+
+def measure(function):
+    """
+    Runs function with its console output muted.
+
+    Returns:
+        tuple: (result, wall seconds, peak traced bytes)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def interpolate_points_runner(cars, stations, west, east, south, north, resolution, **options):
+    from grid_interpolation import interpolate_points
+    return lambda: interpolate_points([cars, stations], [CAR_RADIUS, STATION_RADIUS],
+                                      west, east, south, north, resolution, **options)[2]
+
+
+def engine_runner(cars, stations, west, east, south, north, resolution, **options):
+    lats, lons = grid_axes(west, east, south, north, resolution)
+    points = cars + stations
+    radii = [CAR_RADIUS] * len(cars) + [STATION_RADIUS] * len(stations)
+    return lambda: build_grid(lats, lons, [p["latitude"] for p in points], [p["longitude"] for p in points],
+                              [p["aqi"] for p in points], radii, resolution=resolution, **options)
+
+
+# name -> (runner factory, options, exact)
+METHODS = {
+    "dense": (engine_runner, {"method": "dense"}, True),
+    "splat": (engine_runner, {"method": "splat"}, True),
+    "stamp": (engine_runner, {"method": "stamp"}, False),
+    "tiles": (engine_runner, {"method": "splat", "workers": os.cpu_count()}, True),
+    "float32": (engine_runner, {"method": "splat", "dtype": np.float32}, False),
+    "interpolate_points": (interpolate_points_runner, {}, True),
+}
+
+
+def benchmark_case(case, n_points, methods, seed=0):
+    west, east, south, north, resolution = CASES[case]
+    cars, stations = synthetic_fleet(n_points, west, east, south, north, seed)
+    points = cars + stations
+    radii = [CAR_RADIUS] * len(cars) + [STATION_RADIUS] * len(stations)
+    lats, lons = grid_axes(west, east, south, north, resolution)
+    cells = len(lats) * len(lons)
+
+    golden, golden_source = reference_grid(
+        [p["latitude"] for p in points], [p["longitude"] for p in points], [p["aqi"] for p in points], radii,
+        west, east, south, north, resolution,
+    )
+
+    rows = []
+    for name in methods:
+        runner, options, exact = METHODS[name]
+        if name == "dense" and n_points * cells > DENSE_LIMIT:
+            rows.append((case, n_points, name, cells, None, None, None, "skipped"))
+            continue
+
+        grid, elapsed, peak = measure(runner(cars, stations, west, east, south, north, resolution, **options))
+
+        if golden is None:
+            check = "no golden"
+        else:
+            deviation = float(np.abs(np.asarray(grid, dtype=float) - golden).max()) if cells else 0.0
+            if exact:
+                check = "ok" if np.array_equal(np.asarray(grid), golden) else f"MISMATCH ({deviation:.3g})"
+            else:
+                check = f"max dev {deviation:.3g}"
+            check += f" vs {golden_source}"
+
+        rows.append((case, n_points, name, cells, elapsed, cells / elapsed if elapsed else float("inf"), peak, check))
+
+    return rows, (cars, stations, lats, lons)
+
+
+def benchmark_exports(case, n_points, fleet, max_sdm_cells=1_000_000):
+    """
+    Times Converters.points_to_grid, grid_to_nc and grid_to_sdm on one case.
+    """
+    west, east, south, north, resolution = CASES[case]
+    cars, stations, lats, lons = fleet
+    converter = Converters()
+    sdm_points = to_smart_data_models(cars + stations)
+    rows = []
+
+    (lats, lons, grid), elapsed, peak = measure(
+        lambda: converter.points_to_grid(sdm_points, west, east, south, north, resolution, CAR_RADIUS)
+    )
+    rows.append((case, n_points, "points_to_grid", grid.size, elapsed, grid.size / elapsed, peak, "-"))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        _, elapsed, peak = measure(lambda: converter.grid_to_nc(os.path.join(tmp_dir, "grid.nc"), lats, lons, grid))
+        rows.append((case, n_points, "grid_to_nc", grid.size, elapsed, grid.size / elapsed, peak, "-"))
+
+    if grid.size <= max_sdm_cells:
+        _, elapsed, peak = measure(lambda: converter.grid_to_sdm(case, lats, lons, grid))
+        rows.append((case, n_points, "grid_to_sdm", grid.size, elapsed, grid.size / elapsed, peak, "-"))
+    else:
+        rows.append((case, n_points, "grid_to_sdm", grid.size, None, None, None, "skipped"))
+
+    return rows
+
+
+def print_rows(rows):
+    print(f"{'case':<14}{'points':>8}  {'path':<20}{'cells':>12}{'wall s':>10}{'cells/s':>14}{'peak MB':>10}  check")
+    for case, n_points, name, cells, elapsed, rate, peak, check in rows:
+        if elapsed is None:
+            print(f"{case:<14}{n_points:>8}  {name:<20}{cells:>12}{'-':>10}{'-':>14}{'-':>10}  {check}")
+        else:
+            print(f"{case:<14}{n_points:>8}  {name:<20}{cells:>12}{elapsed:>10.3f}{rate:>14.3g}{peak / 2 ** 20:>10.1f}  {check}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the interpolation engines.")
+    parser.add_argument("--points", default="10,100,1000,10000,100000", help="Comma separated fleet sizes")
+    parser.add_argument("--cases", default="patras,attica,greece_coarse", help=f"Comma separated cases from {list(CASES)}")
+    parser.add_argument("--methods", default="dense,splat,stamp,tiles,float32", help=f"Comma separated paths from {list(METHODS)}")
+    parser.add_argument("--exports", action="store_true", help="Also time points_to_grid, grid_to_nc and grid_to_sdm")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    all_rows = []
+    for case in args.cases.split(","):
+        for n_points in [int(n) for n in args.points.split(",")]:
+            rows, fleet = benchmark_case(case, n_points, args.methods.split(","), args.seed)
+            if args.exports:
+                rows += benchmark_exports(case, n_points, fleet)
+            all_rows += rows
+            print_rows(rows)
+            print()
+
+    mismatches = [row for row in all_rows if "MISMATCH" in row[-1]]
+    if mismatches:
+        raise SystemExit(f"{len(mismatches)} path(s) differ from the golden grid")
@@ -0,0 +1,113 @@
+import os
+
+import numpy as np
+
+# Share of the available memory a single grid (plus work buffers) may use
+MEMORY_FRACTION = 0.5
+
+# Bytes of grid rows processed at once when the grid is computed in chunks
+CHUNK_BYTES = 256 * 2 ** 20
+
+
+def estimate_grid_bytes(shape, dtype=float) -> int:
+    """
+    Bytes needed to hold a grid of the given shape and dtype.
+    """
+    return int(shape[0]) * int(shape[1]) * np.dtype(dtype).itemsize
+
+
+def available_memory_bytes() -> int:
+    """
+    Memory this process can still use, honouring container (cgroup) limits.
+
+    GRID_MEMORY_LIMIT (bytes) in the environment overrides the detection.
+    """
+    if os.getenv("GRID_MEMORY_LIMIT"):
+        return int(os.getenv("GRID_MEMORY_LIMIT"))
+
+    limits = []
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    limits.append(int(line.split()[1]) * 1024)
+                    break
+    except OSError:
+        pass
+
+    for limit_file in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(limit_file) as f:
+                value = f.read().strip()
+            if value.isdigit():
+                limits.append(int(value))
+        except OSError:
+            pass
+
+    if not limits:
+        try:
+            limits.append(os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE"))
+        except (ValueError, OSError, AttributeError):
+            return 2 ** 63 - 1
+    return min(limits)
+
+
+def chunk_rows(shape, dtype=float, chunk_bytes=None) -> int:
+    """
+    Number of grid rows to compute per chunk so a chunk stays below chunk_bytes
+    (CHUNK_BYTES by default).
+    """
+    chunk_bytes = chunk_bytes or CHUNK_BYTES
+    row_bytes = max(1, estimate_grid_bytes((1, shape[1]), dtype))
+    return int(max(1, min(shape[0], chunk_bytes // row_bytes)))
+
+
+def ensure_fits(shape, dtype=float, copies=1):
+    """
+    Raises MemoryError if copies in-memory grids of this shape would not fit
+    in MEMORY_FRACTION of the available memory.
+    """
+    needed = estimate_grid_bytes(shape, dtype) * copies
+    available = available_memory_bytes()
+    if needed > available * MEMORY_FRACTION:
+        raise MemoryError(
+            f"Grid {shape[0]}x{shape[1]} ({np.dtype(dtype).name}) needs {needed / 2 ** 20:.0f} MB "
+            f"but only {available / 2 ** 20:.0f} MB are available, use a memmap file or a coarser resolution"
+        )
+
+
+def allocate_grid(shape, base_value=10, dtype=float, file_name=None):
+    """
+    Allocates a grid filled with base_value, in memory or as an np.memmap.
+
+    The footprint is checked before allocating: an in-memory grid that would
+    not fit in MEMORY_FRACTION of the available memory raises MemoryError
+    instead of getting the container OOM-killed halfway through, and the
+    caller should pass file_name to back the grid with a file.
+
+    Args:
+        shape (tuple): (rows, cols) of the grid.
+        base_value (float): Initial value of every cell.
+        dtype: Cell type, float32 halves the footprint of the default float64.
+        file_name (str): Path of the memmap file, None for an in-memory grid.
+
+    Returns:
+        np.ndarray | np.memmap: The allocated grid.
+    """
+    if file_name is None:
+        ensure_fits(shape, dtype)
+        return np.full(shape, base_value, dtype=dtype)
+
+    grid = np.memmap(file_name, dtype=dtype, mode="w+", shape=tuple(shape))
+    rows = chunk_rows(shape, dtype)
+    for r0 in range(0, shape[0], rows):
+        grid[r0:r0 + rows] = base_value
+    grid.flush()
+    return grid
+
+
+def open_grid(file_name, shape, dtype=float, mode="r+"):
+    """
+    Opens an existing memmap grid created by allocate_grid.
+    """
+    return np.memmap(file_name, dtype=dtype, mode=mode, shape=tuple(shape))
@@ -0,0 +1,432 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from grid_backend import allocate_grid, chunk_rows, ensure_fits, open_grid
+
+# Upper bound on the number of float64 cells materialised by one broadcast
+# step (points x rows x columns). 2**22 cells is ~32 MB per temporary array.
+MAX_CHUNK_CELLS = 2 ** 22
+
+
+def grid_axes(west, east, south, north, resolution=0.001):
+    """
+    Latitude and longitude axes of the interpolation grid.
+
+    Longitudes are sampled at twice the latitude step, matching the grids
+    produced by interpolate_points and Converters.points_to_grid.
+    """
+    lats = np.arange(south, north, resolution)
+    lons = np.arange(west, east, resolution * 2)
+    return lats, lons
+
+
+def radial_decay_array(distance, max_distance):
+    """
+    Vectorized Calculations.radial_decay: 1 - d/r inside the radius, 0 outside.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(distance > max_distance, 0.0, 1 - (distance / max_distance))
+
+
+def _chunk_sizes(n_points, n_rows, n_cols, max_chunk_cells):
+    """
+    Picks (points per chunk, rows per block) so one broadcast step stays
+    below max_chunk_cells.
+    """
+    n_cols = max(n_cols, 1)
+    rows = int(min(n_rows, max(1, max_chunk_cells // n_cols)))
+    points = int(min(n_points, max(1, max_chunk_cells // (rows * n_cols))))
+    return points, rows
+
+
+def accumulate_points(grid, lats, lons, point_lats, point_lons, values, radii, base_value=10,
+                      max_chunk_cells=MAX_CHUNK_CELLS, progress=None):
+    """
+    Adds the radial decay contribution of every point to grid, in place.
+
+    This is the batched equivalent of the per-cell loops in interpolate_points:
+    for every point, each cell gets decay * (value - base_value). Contributions
+    are still added to a cell in point order, so the result is identical to
+    the pure Python loops, while the distance and decay maths run as NumPy
+    broadcasts over (points x rows x columns) chunks bounded by max_chunk_cells.
+
+    Args:
+        grid (np.ndarray): 2D grid of shape (len(lats), len(lons)), updated in place.
+        lats (np.ndarray): Latitude of every grid row.
+        lons (np.ndarray): Longitude of every grid column.
+        point_lats, point_lons, values, radii: Per point arrays (radii in degrees).
+        base_value (float): Value the grid was initialised with.
+        max_chunk_cells (int): Memory bound for a single broadcast step.
+        progress (callable): Optional progress(done_rows, total_rows) callback.
+
+    Returns:
+        np.ndarray: The same grid object.
+    """
+    point_lats = np.asarray(point_lats, dtype=float)
+    point_lons = np.asarray(point_lons, dtype=float)
+    deltas = np.asarray(values, dtype=float) - base_value
+    radii = np.broadcast_to(np.asarray(radii, dtype=float), point_lats.shape)
+
+    n_rows, n_cols = grid.shape
+    if len(point_lats) == 0 or n_rows == 0 or n_cols == 0:
+        return grid
+
+    chunk_points, chunk_rows = _chunk_sizes(len(point_lats), n_rows, n_cols, max_chunk_cells)
+    dlon = lons[None, None, :]
+
+    for r0 in range(0, n_rows, chunk_rows):
+        r1 = min(r0 + chunk_rows, n_rows)
+        block = grid[r0:r1]
+        dlat = lats[None, r0:r1, None]
+
+        for p0 in range(0, len(point_lats), chunk_points):
+            p1 = p0 + chunk_points
+            plat = point_lats[p0:p1, None, None]
+            plon = point_lons[p0:p1, None, None]
+            radius = radii[p0:p1, None, None]
+
+            distance = np.sqrt((dlat - plat) ** 2 + (dlon - plon) ** 2)
+            contributions = radial_decay_array(distance, radius) * deltas[p0:p1, None, None]
+
+            # Add one point at a time to keep the summation order of the loops
+            for contribution in contributions:
+                block += contribution
+
+        if progress is not None:
+            progress(r1, n_rows)
+
+    return grid
+
+
+def point_window(lats, lons, point_lat, point_lon, radius):
+    """
+    Index window [i0:i1, j0:j1] of the cells a point can reach.
+
+    Cells outside the window are further than radius along one axis and
+    receive a zero decay, so skipping them does not change the grid.
+    """
+    i0 = np.searchsorted(lats, point_lat - radius, side="left")
+    i1 = np.searchsorted(lats, point_lat + radius, side="right")
+    j0 = np.searchsorted(lons, point_lon - radius, side="left")
+    j1 = np.searchsorted(lons, point_lon + radius, side="right")
+    return i0, i1, j0, j1
+
+
+@lru_cache(maxsize=64)
+def decay_stamp(radius, lat_resolution, lon_resolution):
+    """
+    Precomputed decay footprint of a point sitting exactly on a grid node.
+
+    Returns:
+        tuple: (stamp, half_rows, half_cols) where stamp has shape
+        (2 * half_rows + 1, 2 * half_cols + 1) and is centred on the node.
+    """
+    half_rows = int(np.floor(radius / lat_resolution))
+    half_cols = int(np.floor(radius / lon_resolution))
+    dlat = np.arange(-half_rows, half_rows + 1)[:, None] * lat_resolution
+    dlon = np.arange(-half_cols, half_cols + 1)[None, :] * lon_resolution
+    stamp = radial_decay_array(np.sqrt(dlat ** 2 + dlon ** 2), radius)
+    stamp.setflags(write=False)
+    return stamp, half_rows, half_cols
+
+
+def splat_points(grid, lats, lons, point_lats, point_lons, values, radii, base_value=10,
+                 resolution=None, snap=False, progress=None):
+    """
+    Adds each point's decay contribution to the cells inside its radius only.
+
+    The cost scales with points x window area instead of points x grid. With
+    snap=False the decay is evaluated on the real cell coordinates of the
+    window, giving the same grid as accumulate_points. With snap=True every
+    point is moved to its nearest grid node and the cached decay_stamp for
+    its (radius, resolution) is added, which skips the distance maths entirely
+    at the cost of up to half a cell of positional error.
+
+    Args:
+        grid (np.ndarray): 2D grid of shape (len(lats), len(lons)), updated in place.
+        lats, lons (np.ndarray): Ascending grid axes.
+        point_lats, point_lons, values, radii: Per point arrays (radii in degrees).
+        base_value (float): Value the grid was initialised with.
+        resolution (float): Latitude step of the grid, required when snap=True.
+            The longitude step is twice as large (see grid_axes).
+        snap (bool): Use the cached stamps instead of exact windows.
+        progress (callable): Optional progress(done_points, total_points) callback.
+
+    Returns:
+        np.ndarray: The same grid object.
+    """
+    point_lats = np.asarray(point_lats, dtype=float)
+    point_lons = np.asarray(point_lons, dtype=float)
+    deltas = np.asarray(values, dtype=float) - base_value
+    radii = np.broadcast_to(np.asarray(radii, dtype=float), point_lats.shape)
+
+    n_rows, n_cols = grid.shape
+    total = len(point_lats)
+    if total == 0 or n_rows == 0 or n_cols == 0:
+        return grid
+
+    if snap:
+        if resolution is None:
+            raise ValueError("resolution is required for snapped stamps")
+        lat_resolution, lon_resolution = resolution, resolution * 2
+
+    step = max(1, total // 100)
+
+    for k in range(total):
+        if snap:
+            stamp, half_rows, half_cols = decay_stamp(float(radii[k]), lat_resolution, lon_resolution)
+            ci = int(np.rint((point_lats[k] - lats[0]) / lat_resolution))
+            cj = int(np.rint((point_lons[k] - lons[0]) / lon_resolution))
+            i0, i1 = max(ci - half_rows, 0), min(ci + half_rows + 1, n_rows)
+            j0, j1 = max(cj - half_cols, 0), min(cj + half_cols + 1, n_cols)
+            if i0 < i1 and j0 < j1:
+                grid[i0:i1, j0:j1] += stamp[
+                    i0 - (ci - half_rows):i1 - (ci - half_rows),
+                    j0 - (cj - half_cols):j1 - (cj - half_cols),
+                ] * deltas[k]
+        else:
+            i0, i1, j0, j1 = point_window(lats, lons, point_lats[k], point_lons[k], radii[k])
+            if i0 < i1 and j0 < j1:
+                distance = np.sqrt(
+                    (lats[i0:i1, None] - point_lats[k]) ** 2 + (lons[None, j0:j1] - point_lons[k]) ** 2
+                )
+                grid[i0:i1, j0:j1] += radial_decay_array(distance, radii[k]) * deltas[k]
+
+        if progress is not None and ((k + 1) % step == 0 or k + 1 == total):
+            progress(k + 1, total)
+
+    return grid
+
+
+def apply_points(grid, lats, lons, point_lats, point_lons, values, radii, base_value=10,
+                 method="splat", resolution=None, progress=None):
+    """
+    Adds the points to grid with the selected interpolation method.
+
+    Methods:
+        "dense": accumulate_points, every point visits the whole grid.
+        "splat": splat_points on exact windows, same output as "dense".
+        "stamp": splat_points with cached, node-snapped decay stamps.
+    """
+    if method == "dense":
+        return accumulate_points(grid, lats, lons, point_lats, point_lons, values, radii,
+                                 base_value=base_value, progress=progress)
+    if method in ("splat", "stamp"):
+        return splat_points(grid, lats, lons, point_lats, point_lons, values, radii,
+                            base_value=base_value, resolution=resolution,
+                            snap=method == "stamp", progress=progress)
+    raise ValueError(f"Unknown interpolation method: {method}")
+
+
+def _points_near(point_lats, point_lons, radii, lat_min, lat_max, lon_min, lon_max):
+    """
+    Mask of the points whose influence radius reaches the given bbox.
+    """
+    halo = float(radii.max()) if len(radii) else 0.0
+    return (
+        (point_lats >= lat_min - halo) & (point_lats <= lat_max + halo)
+        & (point_lons >= lon_min - halo) & (point_lons <= lon_max + halo)
+    )
+
+
+def _interpolate_tile(grid_ref, shape, dtype, rows, cols, lats, lons, point_lats, point_lons, values, radii,
+                      base_value, method, resolution):
+    """
+    Worker side of interpolate_tiles: fills one tile of the shared grid.
+
+    grid_ref is ("shm", name) for a shared memory grid or ("memmap", file_name)
+    for a file backed grid.
+    """
+    kind, name = grid_ref
+    shm = None
+    if kind == "shm":
+        shm = shared_memory.SharedMemory(name=name)
+        grid = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    else:
+        grid = open_grid(name, shape, dtype)
+    try:
+        apply_points(grid[rows[0]:rows[1], cols[0]:cols[1]], lats, lons, point_lats, point_lons, values, radii,
+                     base_value=base_value, method=method, resolution=resolution)
+        if shm is None:
+            grid.flush()
+        del grid
+    finally:
+        if shm is not None:
+            shm.close()
+    return rows, cols
+
+
+def interpolate_tiles(lats, lons, point_lats, point_lons, values, radii, base_value=10, method="splat",
+                      resolution=None, workers=None, tile_shape=None, dtype=float, file_name=None, progress=None):
+    """
+    Interpolates the points on a process pool, one grid tile per task.
+
+    The grid is split into tiles of tile_shape cells. Each task gets its tile's
+    axes plus only the points within the largest influence radius (the halo)
+    of the tile, and writes its result straight into a grid held in shared
+    memory (or to the memmap file_name), so no grid data is pickled between
+    processes. Tiles never overlap and every tile sees its points in the
+    original order, so the result is the same as running apply_points on the
+    whole grid.
+
+    Args:
+        lats, lons (np.ndarray): Ascending grid axes.
+        point_lats, point_lons, values, radii: Per point arrays (radii in degrees).
+        base_value (float): Initial value of every cell.
+        method (str): Interpolation method, see apply_points.
+        resolution (float): Latitude step of the grid (needed by "stamp").
+        workers (int): Number of worker processes, defaults to the CPU count.
+        tile_shape (tuple): (rows, cols) of a tile, defaults to full-width row
+            bands giving two tiles per worker.
+        dtype: Cell type of the grid.
+        file_name (str): Back the grid with this memmap file instead of shared memory.
+        progress (callable): Optional progress(done_tiles, total_tiles) callback.
+
+    Returns:
+        np.ndarray | np.memmap: The interpolated grid.
+    """
+    workers = workers or os.cpu_count() or 1
+    point_lats = np.asarray(point_lats, dtype=float)
+    point_lons = np.asarray(point_lons, dtype=float)
+    values = np.asarray(values, dtype=float)
+    radii = np.broadcast_to(np.asarray(radii, dtype=float), point_lats.shape)
+
+    shape = (len(lats), len(lons))
+    if tile_shape is None:
+        tile_shape = (max(1, math.ceil(shape[0] / (2 * workers))), max(shape[1], 1))
+
+    shm = None
+    if file_name is None:
+        # The shared grid is copied out at the end, so it has to fit twice
+        ensure_fits(shape, dtype, copies=2)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1] * np.dtype(dtype).itemsize))
+        grid = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        grid.fill(base_value)
+        grid_ref = ("shm", shm.name)
+    else:
+        grid = allocate_grid(shape, base_value, dtype, file_name)
+        grid_ref = ("memmap", file_name)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for r0 in range(0, shape[0], tile_shape[0]):
+                r1 = min(r0 + tile_shape[0], shape[0])
+                for c0 in range(0, shape[1], tile_shape[1]):
+                    c1 = min(c0 + tile_shape[1], shape[1])
+                    inside = _points_near(point_lats, point_lons, radii, lats[r0], lats[r1 - 1], lons[c0], lons[c1 - 1])
+                    if not inside.any():
+                        continue
+                    futures.append(executor.submit(
+                        _interpolate_tile, grid_ref, shape, grid.dtype, (r0, r1), (c0, c1),
+                        lats[r0:r1], lons[c0:c1], point_lats[inside], point_lons[inside],
+                        values[inside], radii[inside], base_value, method, resolution,
+                    ))
+
+            for done, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                if progress is not None:
+                    progress(done, len(futures))
+
+        if shm is None:
+            # Re-open so the caller sees what the workers wrote to the file
+            result = open_grid(file_name, shape, dtype)
+        else:
+            result = grid.copy()
+        del grid
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    return result
+
+
+def _build_on_base_grid(lats, lons, point_lats, point_lons, values, radii, base_grid, method, resolution,
+                        workers, dtype, file_name, progress):
+    """
+    Interpolates the points on a per cell background field instead of a constant.
+
+    Every point pulls a cell towards its value by the cell's decay weight d,
+    so on a background B a cell ends up at B + sum(d * (value - B)), which is
+    sum(d * value) + B * (1 - sum(d)). Both sums are ordinary grids with a
+    zero base, so any method, chunking and the process pool still apply.
+    """
+    shape = (len(lats), len(lons))
+    if tuple(np.shape(base_grid)) != shape:
+        raise ValueError(f"Base grid has shape {np.shape(base_grid)}, the grid axes need {shape}")
+
+    options = dict(method=method, resolution=resolution, workers=workers, dtype=dtype)
+    grid = build_grid(lats, lons, point_lats, point_lons, values, radii, base_value=0,
+                      file_name=file_name, progress=progress, **options)
+    weights_file = f"{file_name}.weights" if file_name is not None else None
+    weights = build_grid(lats, lons, point_lats, point_lons, np.ones(len(point_lats)), radii, base_value=0,
+                         file_name=weights_file, **options)
+
+    rows = chunk_rows(shape, dtype)
+    for r0 in range(0, shape[0], rows):
+        r1 = min(r0 + rows, shape[0])
+        grid[r0:r1] += np.asarray(base_grid[r0:r1], dtype=dtype) * (1 - weights[r0:r1])
+    if isinstance(grid, np.memmap):
+        grid.flush()
+
+    del weights
+    if weights_file is not None:
+        os.remove(weights_file)
+    return grid
+
+
+def build_grid(lats, lons, point_lats, point_lons, values, radii, base_value=10, method="splat",
+               resolution=None, workers=1, dtype=float, file_name=None, progress=None, base_grid=None):
+    """
+    Allocates a grid filled with base_value and interpolates the points on it.
+
+    With workers > 1 the work goes to interpolate_tiles. Otherwise the grid is
+    allocated through grid_backend.allocate_grid (in memory, or as a memmap
+    when file_name is given) and, if it is larger than one chunk, computed in
+    row chunks sized by grid_backend.chunk_rows, each chunk only seeing the
+    points that can reach it. Memmap chunks are flushed as they complete.
+
+    A base_grid of the grid's shape (e.g. the satellite AQI layer) replaces
+    the constant base_value as the background, see _build_on_base_grid.
+    """
+    if base_grid is not None:
+        return _build_on_base_grid(lats, lons, point_lats, point_lons, values, radii, base_grid, method,
+                                   resolution, workers, dtype, file_name, progress)
+
+    if workers is not None and workers > 1:
+        return interpolate_tiles(lats, lons, point_lats, point_lons, values, radii, base_value=base_value,
+                                 method=method, resolution=resolution, workers=workers, dtype=dtype,
+                                 file_name=file_name, progress=progress)
+
+    shape = (len(lats), len(lons))
+    grid = allocate_grid(shape, base_value, dtype, file_name)
+    rows = chunk_rows(shape, dtype)
+
+    if rows >= shape[0]:
+        apply_points(grid, lats, lons, point_lats, point_lons, values, radii, base_value=base_value,
+                     method=method, resolution=resolution, progress=progress)
+        return grid
+
+    point_lats = np.asarray(point_lats, dtype=float)
+    point_lons = np.asarray(point_lons, dtype=float)
+    values = np.asarray(values, dtype=float)
+    radii = np.broadcast_to(np.asarray(radii, dtype=float), point_lats.shape)
+
+    for r0 in range(0, shape[0], rows):
+        r1 = min(r0 + rows, shape[0])
+        inside = _points_near(point_lats, point_lons, radii, lats[r0], lats[r1 - 1], lons[0], lons[-1])
+        if inside.any():
+            apply_points(grid[r0:r1], lats[r0:r1], lons, point_lats[inside], point_lons[inside], values[inside],
+                         radii[inside], base_value=base_value, method=method, resolution=resolution)
+        if isinstance(grid, np.memmap):
+            grid.flush()
+        if progress is not None:
+            progress(r1, shape[0])
+
+    return grid
@@ -1,9 +1,8 @@
 from datetime import datetime, timedelta
 import pytz
-import numpy as np
-from influxdb_client import InfluxDBClient, Point, WritePrecision
+from influxdb_client import InfluxDBClient
 from ProgressBar import ProgressBar
-from MathFunctions import Calculations
+from grid_engine import grid_axes, build_grid
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap, BoundaryNorm
 import geopandas as gpd
@@ -13,6 +12,10 @@ from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 import contextily as ctx
 from Converters import Converters
+from HeatmapWriter import HeatmapWriter
+from SatelliteBaseLayer import ensure_base_layer
+from LiveHeatmap import load_live_heatmap, grid_cells
+import glob
 
 load_dotenv()
 
@@ -22,6 +25,21 @@ org = "students"
 BUCKET = "APARS"
 client = InfluxDBClient(url=os.getenv("INFLUX_URL"), token=token, org=org)
 
+# Snapshots written by the ingestion service, kept while younger than the interpolation window
+LIVE_HEATMAP_DIR = os.getenv("LIVE_HEATMAP_DIR", ".")
+LIVE_HEATMAP_MAX_AGE = float(os.getenv("LIVE_HEATMAP_MAX_AGE", 600))  # seconds
+LIVE_HEATMAP_MAX_POINTS = int(os.getenv("LIVE_HEATMAP_MAX_POINTS", 20000))
+
+app = FastAPI()
+
+# Current map of the ingestion service, without querying InfluxDB or interpolating again
+@app.get("/live-heatmap")
+def live_heatmap(max_points: int = LIVE_HEATMAP_MAX_POINTS):
+    live = load_live_heatmap(LIVE_HEATMAP_DIR, max_age=LIVE_HEATMAP_MAX_AGE)
+    if live is None:
+        return JSONResponse(status_code=404, content={"error": "No live heatmap snapshot"})
+    return JSONResponse(content=grid_cells(*live, max_points=max_points))
+
 # Utility to convert to UTC
 def to_utc(timestamp):
     try:
@@ -78,13 +96,10 @@ def query_influxdb(bucket, measurement, fields, last_n_minutes):
         return []
 
 # Interpolation function
-def interpolate_points(points, influence_radius_km, west, east, south, north, resolution=0.001):
+def interpolate_points(points, influence_radius_km, west, east, south, north, resolution=0.001, method="splat", workers=1, dtype=float, grid_file=None, base_grid=None):
     pb = ProgressBar()
 
-    lats = np.arange(south, north, resolution)
-    lons = np.arange(west, east, resolution * 2)
-    lon_grid, lat_grid = np.meshgrid(lons, lats)
-    grid = np.full(lon_grid.shape, 10, dtype=float)  # Base AQI value
+    lats, lons = grid_axes(west, east, south, north, resolution)
 
     clip_points = [
         {"lat": p["latitude"], "lon": p["longitude"], "value": p["aqi"], "radius": r}
@@ -95,13 +110,21 @@ def interpolate_points(points, influence_radius_km, west, east, south, north, re
 
     print(f"Clipping points to {len(clip_points)}")
 
-    for point in clip_points:
-        for i, lat in enumerate(lats):
-            pb.print(i + 1, len(lats), prefix="Progress:", suffix="Complete", length=50)
-            for j, lon in enumerate(lons):
-                distance = np.sqrt((lat - point["lat"]) ** 2 + (lon - point["lon"]) ** 2)
-                decay = Calculations.radial_decay(distance, point["radius"])
-                grid[i, j] += decay * (point["value"] - 10)  # Base AQI value is 10
+    grid = build_grid(
+        lats, lons,
+        [point["lat"] for point in clip_points],
+        [point["lon"] for point in clip_points],
+        [point["value"] for point in clip_points],
+        [point["radius"] for point in clip_points],
+        base_value=10,  # Base AQI value is 10
+        method=method,
+        resolution=resolution,
+        workers=workers,
+        dtype=dtype,
+        file_name=grid_file,
+        progress=lambda done, total: pb.print(done, total, prefix="Progress:", suffix="Complete", length=50),
+        base_grid=base_grid,  # Satellite AQI background (SatelliteBaseLayer) instead of the constant base
+    )
 
     return lats, lons, grid
 
@@ -109,23 +132,16 @@ def interpolate_points(points, influence_radius_km, west, east, south, north, re
 def save_heatmap_to_influx(lats, lons, grid, timestamp):
     pb = ProgressBar()
     try:
-        write_api = client.write_api()
-        points = []
-
-        for i, lat in enumerate(lats):
-            pb.print(i + 1, len(lats), prefix="Progress:", suffix="Complete", length=50)
-            for j, lon in enumerate(lons):
-                point = Point("heatmap") \
-                    .field("aqi", float(grid[i, j])) \
-                    .field("lat", float(lat)) \
-                    .field("lon", float(lon)) \
-                    .time(to_utc(timestamp))
-                
-                points.append(point)
-
-                write_api.write(bucket=BUCKET, org=org, record=point)
-
-        print("Heatmap data saved to InfluxDB.")
+        writer = HeatmapWriter(url=os.getenv("INFLUX_URL"), token=token, org=org, bucket=BUCKET)
+        try:
+            written = writer.write_grid(
+                lats, lons, grid, to_utc(timestamp),
+                progress=lambda done, total: pb.print(done, total, prefix="Progress:", suffix="Complete", length=50),
+            )
+        finally:
+            writer.close()
+
+        print(f"Heatmap data saved to InfluxDB ({written} cells).")
     except Exception as e:
         print(f"Error saving heatmap: {e}")
 
@@ -181,7 +197,16 @@ if __name__ == "__main__":
     south, north = 34.8021, 41.7489
     west, east = 19.3646, 29.6425
 
-    lats, lons, grid = interpolate_points([car_data, station_data], [0.01, 0.02], west, east, south, north)
+    # Start from the satellite AQI layer when the CAMS files are available
+    base_grid = None
+    if os.getenv("CAMS_DIR"):
+        base_grid = ensure_base_layer(
+            sorted(glob.glob(os.path.join(os.getenv("CAMS_DIR"), "*.nc"))),
+            west, east, south, north,
+            file_name=os.getenv("BASE_LAYER_FILE", "base_layer.npz"),
+        )
+
+    lats, lons, grid = interpolate_points([car_data, station_data], [0.01, 0.02], west, east, south, north, workers=os.cpu_count(), base_grid=base_grid)
     # for i in range(10):
     #     for j in range(10):
     #         print(f"{lats[i]}, {lons[j]} -> {grid[i][j]}")
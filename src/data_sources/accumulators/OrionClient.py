@@ -0,0 +1,134 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Orion rejects request bodies over 1 MB by default (-inReqPayloadMaxSize)
+MAX_BATCH_BYTES = 900_000
+
+# Responses worth retrying, everything else is reported right away
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class OrionClient:
+    """
+    NGSI v2 client shared by the accumulators.
+
+    Entities are upserted through /v2/op/update in chunks of at most
+    batch_size entities (and MAX_BATCH_BYTES), sent by up to max_workers
+    concurrent requests over one keep-alive connection pool. Connection
+    errors and 429/5xx responses are retried with exponential backoff.
+
+    A client shared by threads calling upsert_entities concurrently keeps at
+    most max_connections requests in flight in total, the size of the pool.
+    """
+
+    def __init__(self, orion_url: str, batch_size: int = 1000, max_workers: int = 4, retries: int = 3,
+                 backoff: float = 0.5, timeout: float = 30.0, max_requests_per_second: float = None,
+                 max_connections: int = None, logger: logging.Logger = None):
+        """
+        Args:
+            orion_url (str): Base NGSI v2 URL, e.g. http://orion:1026/v2 (the ORION_URL variable).
+            max_requests_per_second (float): Rate limit shared by all workers, None for no limit.
+            max_connections (int): Requests in flight across all upsert_entities calls, max_workers by default.
+        """
+        self.orion_url = orion_url.rstrip("/")
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.min_interval = 1.0 / max_requests_per_second if max_requests_per_second else 0.0
+        self._next_request = time.monotonic()
+        self._rate_lock = threading.Lock()
+        self.max_connections = max_connections or max_workers
+        self._connections = threading.BoundedSemaphore(self.max_connections)
+        self.logger = logger or logging.getLogger("ORION-CLIENT")
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+
+    def chunks(self, entities, action_type: str = "append"):
+        """
+        Yields (entity count, request body) pairs of /v2/op/update batches.
+
+        Every entity is serialized once and the body is assembled from the
+        serialized entities, so the byte limit costs no extra encoding.
+        """
+        prefix = '{"actionType": %s, "entities": [' % json.dumps(action_type)
+        suffix = "]}"
+        batch, batch_bytes = [], len(prefix) + len(suffix)
+
+        for entity in entities:
+            encoded = json.dumps(entity)
+            if batch and (len(batch) >= self.batch_size or batch_bytes + len(encoded) + 1 > MAX_BATCH_BYTES):
+                yield len(batch), prefix + ",".join(batch) + suffix
+                batch, batch_bytes = [], len(prefix) + len(suffix)
+            batch.append(encoded)
+            batch_bytes += len(encoded) + 1
+
+        if batch:
+            yield len(batch), prefix + ",".join(batch) + suffix
+
+    def _throttle(self):
+        if not self.min_interval:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_request - now
+            self._next_request = max(now, self._next_request) + self.min_interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def _post_batch(self, count: int, body: str) -> int:
+        url = f"{self.orion_url}/op/update"
+        for attempt in range(self.retries + 1):
+            try:
+                with self._connections:
+                    self._throttle()
+                    response = self.session.post(url, data=body.encode("utf-8"), timeout=self.timeout)
+                if response.status_code == 204:
+                    return count
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                    self.logger.error(f"Failed to upsert {count} entities: {response.status_code} - {response.text}")
+                    return 0
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    self.logger.error(f"Failed to upsert {count} entities: {str(e)}")
+                    return 0
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def upsert_entities(self, entities, action_type: str = "append") -> int:
+        """
+        Creates or updates the entities in Orion.
+
+        Args:
+            entities (iterable): NGSI v2 entities with "id" and "type".
+            action_type (str): "append" (upsert, the default), "appendStrict", "update", "replace" or "delete".
+
+        Returns:
+            int: Number of entities Orion accepted.
+        """
+        in_flight = threading.BoundedSemaphore(self.max_workers)
+        futures = []
+
+        # At most max_workers bodies are built ahead of the requests
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for count, body in self.chunks(entities, action_type):
+                in_flight.acquire()
+                future = executor.submit(self._post_batch, count, body)
+                future.add_done_callback(lambda _: in_flight.release())
+                futures.append(future)
+        sent = sum(future.result() for future in futures)
+        self.logger.info(f"Upserted {sent} entities to Orion in {len(futures)} batch(es)")
+        return sent
+
+    def close(self):
+        self.session.close()
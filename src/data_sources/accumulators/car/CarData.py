@@ -1,8 +1,8 @@
+import os
 import serial
 import time
 import argparse
 import ssl
-import json
 from subprocess import PIPE, Popen, check_output
 import paho.mqtt.client as mqtt
 from bme280 import BME280
@@ -13,6 +13,10 @@ from smbus2 import SMBus
 from PIL import Image, ImageDraw, ImageFont
 from fonts.ttf import RobotoMedium as UserFont
 import st7735
+from CarWireFormat import encode_payload
+
+# "binary" (see CarWireFormat) or "json" for accumulators that predate it
+WIRE_FORMAT = os.getenv('CAR_WIRE_FORMAT', 'binary')
 
 # Initialize sensors
 ltr559 = LTR559()
@@ -170,7 +174,7 @@ def main():
         while True:
             data = collect_data(serial_port, bme280, pms5003, has_pms)
             print(f"Collected data: {data}")
-            mqtt_client.publish("apars_cars", json.dumps(data), retain=True)
+            mqtt_client.publish("apars_cars", encode_payload(data, WIRE_FORMAT), retain=True)
             time.sleep(3)
     except KeyboardInterrupt:
         print("Exiting...")
@@ -1,53 +1,101 @@
 import paho.mqtt.client as mqtt
-import requests
+import sys
+import threading
+import time
 import logging
 import logging.config
-import json
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
+from CarWireFormat import decode
+
+# The Orion client is shared by all accumulators
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from OrionClient import OrionClient
 
 load_dotenv()
 
 BROKER_ADDRESS = os.getenv('MQTT_ADDRESS')
 BROKER_PORT = int(os.getenv('MQTT_PORT'))
 TOPICS = ["apars_cars"] # ["car_1", "car_2", "car_3"] #os.getenv('CAR_TOPICS', '').split(',') if os.getenv('CAR_TOPICS', '') else []
-ORION_URL = os.getenv('ORION_URL')+"/entities"
+ORION_URL = os.getenv('ORION_URL')
+# Seconds between two flushes of the latest car states to Orion
+ORION_FLUSH_INTERVAL = float(os.getenv('ORION_FLUSH_INTERVAL', 1.0))
 
 logging.basicConfig(level=logging.INFO)
 logging.config.fileConfig('../../../logging.conf')
 logger = logging.getLogger("MQTT-To-Orion")
 
-def send_data_to_orion(payload):
-    """Send data to Orion Context Broker."""
-    headers = {
-        "Content-Type": "application/json"
-    }
-    try:
-        data = to_orion_format(payload)#json.loads(payload)
-
-        entity_id = data["id"]
-
-        url = f"{ORION_URL}/{entity_id}/attrs"
-
-        response = requests.patch(url, headers=headers, json={key: value for key, value in data.items() if key not in ["id", "type"]})
-
-        if response.status_code == 204:
-            logger.info(f"Data updated successfully! CAR ID: {entity_id}")
-        elif response.status_code == 404:  # Entity not found, create it
-            response = requests.post(ORION_URL, headers=headers, json=data)
-            if response.status_code == 201:
-                logger.info(f"Data created successfully! CAR ID: {entity_id}")
-            else:
-                logger.error(f"Failed to create entity: {response.status_code} - {response.text}")
-        else:
-            logger.error(f"Failed to send data: {response.status_code} - {response.text}")
-    except Exception as e:
-        logger.error(f"Error while sending data to Orion: {str(e)}")
+# Newest Orion entity of every car that was not sent yet, keyed by car id
+latest_state = {}
+latest_state_lock = threading.Lock()
+stats = {"received": 0, "superseded": 0, "sent": 0}
+
+orion = OrionClient(ORION_URL, logger=logger)
+
+
+def store_latest_state(payload):
+    """
+    Decodes a reading and keeps it as the car's latest state.
+
+    A reading that was not sent before the next one of the same car arrives
+    is superseded and never reaches Orion.
+    """
+    data = to_orion_format(payload)
+    with latest_state_lock:
+        stats["received"] += 1
+        if data["id"] in latest_state:
+            stats["superseded"] += 1
+        latest_state[data["id"]] = data
+
+
+def flush_latest_state():
+    """
+    Sends the pending latest state of every car to Orion.
+
+    When Orion did not accept every car, the pending states go back into
+    latest_state for the next flush, unless a newer reading of the same car
+    arrived meanwhile. The client does not tell which batch failed, so the
+    accepted ones are resent too, which an upsert makes harmless.
+
+    Returns:
+        int: Number of cars sent.
+    """
+    global latest_state
+    with latest_state_lock:
+        pending, latest_state = latest_state, {}
+
+    if not pending:
+        return 0
+    sent = orion.upsert_entities(list(pending.values()))
+    with latest_state_lock:
+        stats["sent"] += sent
+        if sent < len(pending):
+            for car_id, data in pending.items():
+                latest_state.setdefault(car_id, data)
+    if sent < len(pending):
+        logger.error(f"Only {sent} of {len(pending)} car(s) reached Orion, keeping them for the next flush")
+    return sent
+
+
+def send_forever(stop):
+    """
+    Flushes the latest car states every ORION_FLUSH_INTERVAL seconds, so
+    Orion load is bounded by the fleet size instead of the message rate.
+    """
+    while not stop.is_set():
+        started = time.monotonic()
+        sent = flush_latest_state()
+        if sent:
+            with latest_state_lock:
+                logger.info(f"Sent {sent} car(s) to Orion ({stats['received']} received, "
+                            f"{stats['superseded']} superseded, {stats['sent']} sent in total)")
+        stop.wait(max(0.0, ORION_FLUSH_INTERVAL - (time.monotonic() - started)))
 
 
 def to_orion_format(payload):
-    payload = list(json.loads(payload))
+    # Binary (CarWireFormat) or JSON encoded reading list
+    payload = decode(payload)
 
     return {  
             "id": payload[0],  
@@ -115,9 +163,8 @@ def on_connect(client, userdata, flags, rc):
 def on_message(client, userdata, msg):
     logger.info(f"Message received from topic {msg.topic}")
     try:
-        payload = msg.payload.decode("utf-8")
-        logger.info(f"Payload: {payload}")
-        send_data_to_orion(payload)
+        logger.debug(f"Payload: {msg.payload}")
+        store_latest_state(msg.payload)
     except Exception as e:
         logger.error(f"Error processing message from topic {msg.topic}: {str(e)}")
 
@@ -135,4 +182,13 @@ if __name__ == "__main__":
         logger.error(f"Failed to connect to MQTT broker: {str(e)}")
         quit()
 
-    client.loop_forever()
\ No newline at end of file
+    stop = threading.Event()
+    sender = threading.Thread(target=send_forever, args=(stop,), name="orion-sender", daemon=True)
+    sender.start()
+    try:
+        client.loop_forever()
+    finally:
+        stop.set()
+        sender.join()
+        flush_latest_state()
+        orion.close()
\ No newline at end of file
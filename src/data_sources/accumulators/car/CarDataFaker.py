@@ -10,11 +10,14 @@ import threading
 import random
 import os
 from dotenv import load_dotenv
+from CarWireFormat import encode_payload
 
 load_dotenv()
 
 BROKER_ADDRESS = os.getenv('MQTT_ADDRESS')
 BROKER_PORT = int(os.getenv('MQTT_PORT'))
+# "binary" (see CarWireFormat) or "json" for accumulators that predate it
+WIRE_FORMAT = os.getenv('CAR_WIRE_FORMAT', 'binary')
 
 
 def generate_random_coordinates(east, west, north, south):
@@ -156,7 +159,7 @@ def load_car_data(filename="car_data.json"):
 
 
 def publish_to_mqtt(client, topic, payload):
-    client.publish(topic, json.dumps(payload))
+    client.publish(topic, encode_payload(payload, WIRE_FORMAT))
     print(f"Published to {topic}: {json.dumps(payload)}")
 
 
@@ -0,0 +1,159 @@
+"""
+Binary wire format of the car telemetry published on MQTT.
+
+A reading is the positional list built by CarData.collect_data and
+CarDataFaker:
+
+    [car_id, timestamp, latitude, longitude, pm1, pm25, pm10, oxidised, reduced, nh3]
+
+Version 2 packs it big-endian as
+
+    header  B version | B flags | B id length
+    id      id length bytes of UTF-8
+    body    q timestamp (microseconds of the wall-clock time since 1970-01-01T00:00)
+            i UTC offset of the timestamp in seconds (FLAG_UTC_OFFSET)
+            i latitude, i longitude (1e-7 degrees)
+            6 x i pm1, pm25, pm10, oxidised, reduced, nh3 (1/100 units)
+
+which is about half the size of the JSON list. ISO timestamps keep their
+wall-clock fields, so a naive one decodes to the same naive string wherever
+the accumulator runs, and an offset-aware one keeps its offset.
+
+Version 1 stored naive timestamps as epoch microseconds of the publisher's
+local time zone and decoded them in the accumulator's, shifting them when
+the two differ. Its payloads are still decoded, with that shift. JSON lists are still
+accepted by decode(), so old publishers keep working; a payload is binary
+when its first byte is a known version (JSON always starts with "[" or
+whitespace).
+"""
+
+import json
+import struct
+from datetime import datetime, timedelta, timezone
+
+VERSION = 2
+
+HEADER = struct.Struct(">BBB")
+BODY_V1 = struct.Struct(">qii6i")
+BODY_V2 = struct.Struct(">qiii6i")
+
+# Flags
+FLAG_EPOCH_SECONDS = 0x01  # timestamp was an int of epoch seconds, not an ISO string
+FLAG_NO_FIX = 0x02         # no GPS fix, latitude and longitude were ''
+FLAG_UTC_OFFSET = 0x04     # ISO timestamp had a UTC offset (version 2)
+
+EPOCH = datetime(1970, 1, 1)
+
+COORDINATE_SCALE = 10 ** 7
+VALUE_SCALE = 100
+
+WIRE_FORMATS = ("binary", "json")
+
+
+def _fixed(value, scale):
+    return int(round(float(value) * scale))
+
+
+def encode(reading) -> bytes:
+    """
+    Packs a positional reading list into the current binary version.
+
+    Coordinates keep 7 decimals (~1 cm) and pollutant values 2 decimals.
+    """
+    car_id, timestamp, latitude, longitude, *values = reading
+    car_id = str(car_id).encode("utf-8")
+    if len(car_id) > 255:
+        raise ValueError(f"Car id is longer than 255 bytes: {car_id!r}")
+
+    flags = 0
+    utc_offset = 0
+    if isinstance(timestamp, str):
+        observed = datetime.fromisoformat(timestamp)
+        if observed.utcoffset() is not None:
+            flags |= FLAG_UTC_OFFSET
+            utc_offset = int(observed.utcoffset().total_seconds())
+        microseconds = (observed.replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+    else:
+        flags |= FLAG_EPOCH_SECONDS
+        microseconds = int(timestamp) * 10 ** 6
+
+    if latitude == '' or longitude == '':
+        flags |= FLAG_NO_FIX
+        latitude = longitude = 0
+
+    return HEADER.pack(VERSION, flags, len(car_id)) + car_id + BODY_V2.pack(
+        microseconds,
+        utc_offset,
+        _fixed(latitude, COORDINATE_SCALE),
+        _fixed(longitude, COORDINATE_SCALE),
+        *[_fixed(value, VALUE_SCALE) for value in values],
+    )
+
+
+def _decode_v1(payload: bytes, flags: int, id_length: int) -> list:
+    start = HEADER.size
+    car_id = payload[start:start + id_length].decode("utf-8")
+    microseconds, latitude, longitude, *values = BODY_V1.unpack_from(payload, start + id_length)
+
+    if flags & FLAG_EPOCH_SECONDS:
+        timestamp = microseconds // 10 ** 6
+    else:
+        seconds, microseconds = divmod(microseconds, 10 ** 6)
+        timestamp = (datetime.fromtimestamp(seconds) + timedelta(microseconds=microseconds)).isoformat()
+
+    if flags & FLAG_NO_FIX:
+        latitude = longitude = ''
+    else:
+        latitude, longitude = latitude / COORDINATE_SCALE, longitude / COORDINATE_SCALE
+
+    return [car_id, timestamp, latitude, longitude, *[value / VALUE_SCALE for value in values]]
+
+
+def _decode_v2(payload: bytes, flags: int, id_length: int) -> list:
+    start = HEADER.size
+    car_id = payload[start:start + id_length].decode("utf-8")
+    microseconds, utc_offset, latitude, longitude, *values = BODY_V2.unpack_from(payload, start + id_length)
+
+    if flags & FLAG_EPOCH_SECONDS:
+        timestamp = microseconds // 10 ** 6
+    else:
+        observed = EPOCH + timedelta(microseconds=microseconds)
+        if flags & FLAG_UTC_OFFSET:
+            observed = observed.replace(tzinfo=timezone(timedelta(seconds=utc_offset)))
+        timestamp = observed.isoformat()
+
+    if flags & FLAG_NO_FIX:
+        latitude = longitude = ''
+    else:
+        latitude, longitude = latitude / COORDINATE_SCALE, longitude / COORDINATE_SCALE
+
+    return [car_id, timestamp, latitude, longitude, *[value / VALUE_SCALE for value in values]]
+
+
+DECODERS = {1: _decode_v1, 2: _decode_v2}
+
+
+def decode(payload) -> list:
+    """
+    Decodes a binary or JSON payload to the positional reading list.
+    """
+    if isinstance(payload, str):
+        return list(json.loads(payload))
+
+    payload = bytes(payload)
+    if payload and payload[0] in DECODERS:
+        version, flags, id_length = HEADER.unpack_from(payload)
+        return DECODERS[version](payload, flags, id_length)
+
+    return list(json.loads(payload.decode("utf-8")))
+
+
+def encode_payload(reading, wire_format: str = "binary"):
+    """
+    Encodes a reading for publishing in the given wire format ("binary" or "json").
+    """
+    if wire_format == "json":
+        return json.dumps(reading)
+    if wire_format == "binary":
+        return encode(reading)
+    raise ValueError(f"Unknown wire format '{wire_format}', expected one of {WIRE_FORMATS}")
@@ -1,19 +1,28 @@
 import glob
 import cdsapi
 import numpy as np
-import netCDF4 as nc
 from netCDF4 import Dataset
 import zipfile
 import os
 import json
-import requests
+import sys
 import logging
 import logging.config
-from datetime import datetime
+from datetime import datetime, date, timedelta
+import hashlib
+import shutil
 import os
 from dotenv import load_dotenv
 import schedule
 import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# The Orion client is shared by all accumulators
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from OrionClient import OrionClient
 
 load_dotenv()
 
@@ -23,6 +32,11 @@ logger = logging.getLogger('SATELLITE_ACCUMULATOR')
 
 ORION_URL = os.getenv('ORION_URL')
 
+# The CAMS cells now reach the heatmap as the interpolation base layer
+# (backend/interpolation/SatelliteBaseLayer.py reading CAMS_DIR). Pushing every
+# cell to Orion as well is opt-in.
+PUSH_TO_ORION = os.getenv('SATELLITE_PUSH_TO_ORION', 'false').lower() in ('1', 'true', 'yes')
+
 dataset = "cams-europe-air-quality-forecasts"
 
 request = {
@@ -52,44 +66,54 @@ request = {
     "data_format": "netcdf_zip"
 }
 
-filename = "copernicus_2024_11_28_2024_11_29_0_2.zip"
+# Downloads are cached under a hash of their request, processed slices are kept in the ledger
+CACHE_DIR = os.getenv('SATELLITE_CACHE_DIR', "satellite_cache")
+LEDGER_FILE = os.getenv('SATELLITE_LEDGER_FILE', "satellite_ledger.json")
+# Latest CAMS files, read by the interpolation base layer (its CAMS_DIR)
+LATEST_DIR = os.getenv('SATELLITE_LATEST_DIR', "satellite_accumulated")
+# When set, the request covers the last SATELLITE_LOOKBACK_DAYS days up to today instead of its fixed dates
+LOOKBACK_DAYS = os.getenv('SATELLITE_LOOKBACK_DAYS')
+# Processes converting and pushing variables in parallel
+WORKERS = int(os.getenv('SATELLITE_WORKERS', os.cpu_count() or 1))
+
+
+# (grid signature, bbox) -> (latitude index range, longitude index range)
+_bbox_index_ranges = {}
+
+
+def _axis_range(values, low, high):
+    """
+    The contiguous index range of values inside [low, high], for ascending
+    or descending axes. A boolean mask is returned for non monotonic axes.
+    """
+    inside = (values >= low) & (values <= high)
+    indices = np.flatnonzero(inside)
+    if indices.size == 0:
+        return slice(0, 0)
+    start, stop = int(indices[0]), int(indices[-1]) + 1
+    if stop - start != indices.size:
+        return inside
+    return slice(start, stop)
 
 
-def split_nc_by_parameter(input_file, output_dir):
+def bbox_index_ranges(lat, lon, west, east, south, north):
     """
-    Creates separate .nc files for each parameter in the input satellite.nc file
-    without any AQI conversion.
+    Turns a bbox into latitude and longitude index ranges of a grid.
 
-    Args:
-        input_file (str): Path to the input satellite.nc file.
-        output_dir (str): Directory to save the output .nc files.
+    netCDF4 reads a start:stop hyperslab directly, while boolean masks go
+    through its slow fancy indexing. The ranges are cached for every file
+    sharing the same grid (size and end points of both axes).
+
+    Returns:
+        tuple: (latitude slice, longitude slice)
     """
-    with nc.Dataset(input_file, 'r') as src_ds:
-        for var_name in src_ds.variables:
-            if var_name in ['longitude', 'latitude', 'time', 'level']:
-                continue  # Skip coordinate variables
-            
-            var = src_ds.variables[var_name]
-            output_file = f"{output_dir}/{var_name}.nc"
-            with nc.Dataset(output_file, 'w', format='NETCDF4') as dst_ds:
-                # Copy dimensions
-                for dim_name, dim in src_ds.dimensions.items():
-                    dst_ds.createDimension(dim_name, len(dim) if not dim.isunlimited() else None)
-                
-                # Copy coordinate variables
-                for dim_name in ['latitude', 'longitude', 'time', 'level']:
-                    if dim_name in src_ds.variables:
-                        src_var = src_ds.variables[dim_name]
-                        dst_var = dst_ds.createVariable(dim_name, src_var.datatype, src_var.dimensions)
-                        dst_var.setncatts({k: getattr(src_var, k) for k in src_var.ncattrs()})
-                        dst_var[:] = src_var[:]
-                
-                # Copy the variable
-                dst_var = dst_ds.createVariable(var_name, var.datatype, var.dimensions)
-                dst_var.setncatts({k: getattr(var, k) for k in var.ncattrs()})
-                dst_var[:] = var[:]
-            
-            print(f"File {output_file} created successfully.")
+    lat = np.asarray(lat)
+    lon = np.asarray(lon)
+    key = (lat.size, float(lat[0]), float(lat[-1]), lon.size, float(lon[0]), float(lon[-1]),
+           west, east, south, north)
+    if key not in _bbox_index_ranges:
+        _bbox_index_ranges[key] = (_axis_range(lat, south, north), _axis_range(lon, west, east))
+    return _bbox_index_ranges[key]
 
 
 def unzip_file(zip_file_path, output_dir):
@@ -113,99 +137,61 @@ def unzip_file(zip_file_path, output_dir):
         print(f"An error occurred: {e}")
 
 
-def netcdf_to_json_filtered(nc_file, json_file, west, east, south, north):
+def netcdf_to_orion_entities(nc_file, west, east, south, north, region="Greece", variables=None):
     """
-    Converts a netCDF4 file to JSON, filtering data based on geographical bounds.
-    
+    Streams the cells of a netCDF4 file inside the bounding box as Orion
+    entities, without intermediate files.
+
+    Only one variable's bbox subset is in memory at a time and entities are
+    yielded lazily: one SatelliteAirQualityObserved entity per cell, with the
+    value under the variable name and [lon, lat] coordinates. Variables
+    with more dimensions than latitude and longitude (time, level) are read
+    at the first index of those.
+
     Parameters:
         nc_file (str): Path to the netCDF4 file.
-        json_file (str): Path to the output JSON file.
-        west (float): Western longitude limit.
-        east (float): Eastern longitude limit.
-        south (float): Southern latitude limit.
-        north (float): Northern latitude limit.
-    """
-    # Open the netCDF4 file
-    with Dataset(nc_file, mode="r") as nc:
-        data = {}
-        
-        # Global attributes
-        data["global_attributes"] = {attr: getattr(nc, attr) for attr in nc.ncattrs()}
-        
-        # Dimensions
-        data["dimensions"] = {dim: len(nc.dimensions[dim]) for dim in nc.dimensions}
-        
-        # Find the indices for the bounding box
-        lat = nc.variables["latitude"][:]
-        lon = nc.variables["longitude"][:]
-        
-        lat_indices = (lat >= south) & (lat <= north)
-        lon_indices = (lon >= west) & (lon <= east)
-        
-        # Variables
-        data["variables"] = {}
-        for var_name, variable in nc.variables.items():
-            var_data = {
-                "dimensions": variable.dimensions,
-                "attributes": {attr: getattr(variable, attr) for attr in variable.ncattrs()}
-            }
-            
-            # Extract and filter data based on lat/lon bounds
-            if "latitude" in variable.dimensions and "longitude" in variable.dimensions:
-                lat_dim = variable.dimensions.index("latitude")
-                lon_dim = variable.dimensions.index("longitude")
-                
-                # Create slices for the variable's data
-                slices = [slice(None)] * len(variable.dimensions)  # Default: take all data
-                slices[lat_dim] = lat_indices
-                slices[lon_dim] = lon_indices
-                
-                # Filter and convert to list
-                var_data["data"] = variable[tuple(slices)].tolist()
-            else:
-                # Non-spatial data or variables
-                var_data["data"] = variable[:].tolist()
-            
-            data["variables"][var_name] = var_data
-        
-        # Write filtered data to JSON
-        with open(json_file, "w") as json_out:
-            json.dump(data, json_out, indent=4)
-    
-    print(f"Filtered data from {nc_file} based on geographical bounds and saved to {json_file}")
-
-
-def json_to_orion_entities(json_data, region="Greece"):
-    """
-    Converts JSON payload into Orion Context Broker-compatible entities,
-    including latitude, longitude, and value dynamically.
-
-    Args:
-        json_data (dict): The JSON data to be converted.
+        west, east, south, north (float): Geographical bounds.
         region (str): The region to be used in the entity IDs (default is "Greece").
+        variables (list): Only stream these variables, all of them when None.
 
-    Returns:
-        list: A list of entities ready to be posted to Orion Context Broker.
+    Yields:
+        dict: Orion entities.
     """
-    entities = []
-    latitudes = json_data["variables"].get("latitude", {}).get("data", [])
-    longitudes = json_data["variables"].get("longitude", {}).get("data", [])
-    
-    # Loop through all parameters and their data
-    for param, param_data in json_data.get("variables", {}).items():
-        if param in ['longitude', 'latitude', 'time', 'level']:
-            continue  # Skip coordinates
-        
-        data_values = param_data.get("data", [])
-
-        timestamp = datetime.utcnow().isoformat()
-        
-        # Create entities dynamically for each latitude/longitude pair and value
-        for i, lat in enumerate(latitudes):
-            for j, lon in enumerate(longitudes):
-                value = data_values[i][j] if i < len(data_values) and j < len(data_values[i]) else None
-                if value is not None:
-                    entity = {
+    with Dataset(nc_file, mode="r") as ds:
+        lat = ds.variables["latitude"][:]
+        lon = ds.variables["longitude"][:]
+
+        lat_indices, lon_indices = bbox_index_ranges(lat, lon, west, east, south, north)
+        latitudes = np.asarray(lat[lat_indices], dtype=float).tolist()
+        longitudes = np.asarray(lon[lon_indices], dtype=float).tolist()
+
+        for param, variable in ds.variables.items():
+            if param in ['longitude', 'latitude', 'time', 'level']:
+                continue  # Skip coordinates
+            if "latitude" not in variable.dimensions or "longitude" not in variable.dimensions:
+                continue
+            if variables is not None and param not in variables:
+                continue
+
+            slices = [0] * len(variable.dimensions)
+            slices[variable.dimensions.index("latitude")] = lat_indices
+            slices[variable.dimensions.index("longitude")] = lon_indices
+            values = variable[tuple(slices)]
+            if variable.dimensions.index("latitude") > variable.dimensions.index("longitude"):
+                values = values.T
+
+            # Masked (fill value) cells are skipped, as None was in the JSON path
+            missing = np.ma.getmaskarray(values)
+            values = np.ma.getdata(values)
+
+            timestamp = datetime.utcnow().isoformat()
+
+            for i, lat_value in enumerate(latitudes):
+                row, row_missing = values[i].tolist(), missing[i]
+                for j, lon_value in enumerate(longitudes):
+                    if row_missing[j]:
+                        continue
+                    yield {
                         "id": f"satellite_{param}",
                         "type": "SatelliteAirQualityObserved",
                         "dateObserved": {
@@ -214,88 +200,298 @@ def json_to_orion_entities(json_data, region="Greece"):
                         },
                         f"{param}": {
                             "type": "Float",
-                            "value": value
+                            "value": row[j]
                         },
                         "location": {
                             "type": "geo:json",
                             "value": {
                                 "type": "Point",
-                                "coordinates": [lon, lat]
+                                "coordinates": [lon_value, lat_value]
                             }
                         }
                     }
-                    entities.append(entity)
-    return entities
 
 
-def send_data_to_orion(payload):
-    """Send data to Orion Context Broker."""
-    headers = {
-        "Content-Type": "application/json"
-    }
+def current_request():
+    """
+    The request of this run: the fixed request, or with SATELLITE_LOOKBACK_DAYS
+    its date range moved to end today.
+    """
+    current = dict(request)
+    if LOOKBACK_DAYS:
+        today = date.today()
+        current["date"] = [f"{today - timedelta(days=int(LOOKBACK_DAYS))}/{today}"]
+    return current
+
+
+def request_dates(dates):
+    """
+    Expands the "start/end" ranges of a CDS date list to single ISO dates.
+    """
+    days = []
+    for entry in dates:
+        start, _, end = entry.partition("/")
+        day, last = date.fromisoformat(start), date.fromisoformat(end or start)
+        while day <= last:
+            days.append(day.isoformat())
+            day += timedelta(days=1)
+    return days
+
+
+def request_key(cds_request):
+    """
+    Content address of a request: the same request always maps to the same download.
+    """
+    encoded = json.dumps({"dataset": dataset, "request": cds_request}, sort_keys=True)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:16]
+
+
+def load_ledger(ledger_file):
+    if not os.path.exists(ledger_file):
+        return set()
+    with open(ledger_file, "r") as file:
+        return set(json.load(file)["processed"])
+
+
+def save_ledger(ledger_file, processed):
+    tmp_file = f"{ledger_file}.tmp"
+    with open(tmp_file, "w") as file:
+        json.dump({"processed": sorted(processed)}, file)
+    os.replace(tmp_file, ledger_file)
+
+
+def slice_key(day, hour, variable):
+    return f"{day}|{hour}|{variable}"
+
+
+def missing_requests(cds_request, processed):
+    """
+    Splits the request into one request per date holding only the times and
+    variables of that date that were not processed yet.
+
+    Returns:
+        list: (request, slice keys it covers) pairs, empty when everything was processed.
+    """
+    pending = []
+    for day in request_dates(cds_request["date"]):
+        missing = [
+            (hour, variable)
+            for hour in cds_request["time"]
+            for variable in cds_request["variable"]
+            if slice_key(day, hour, variable) not in processed
+        ]
+        if not missing:
+            continue
+        hours = sorted({hour for hour, _ in missing})
+        variables = sorted({variable for _, variable in missing})
+        day_request = dict(cds_request, date=[f"{day}/{day}"], time=hours, variable=variables)
+        slices = {slice_key(day, hour, variable) for hour in hours for variable in variables}
+        pending.append((day_request, slices))
+    return pending
+
+
+def download_cached(client, cds_request, cache_dir):
+    """
+    Downloads and unzips a request once, later calls reuse the cached files.
+
+    Returns:
+        list: The request's netCDF files.
+    """
+    key = request_key(cds_request)
+    zip_file = os.path.join(cache_dir, f"{key}.zip")
+    extract_dir = os.path.join(cache_dir, key)
+
+    if not os.path.exists(zip_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{zip_file}.part"
+        client.retrieve(dataset, cds_request, tmp_file)
+        os.replace(tmp_file, zip_file)
+    else:
+        logger.info(f"Using cached download {zip_file}")
+
+    nc_files = sorted(glob.glob(os.path.join(extract_dir, "*.nc")))
+    if nc_files:
+        return nc_files
+
+    # Extracted next to extract_dir first, so an interrupted unzip never looks complete
+    tmp_dir = f"{extract_dir}.part"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    unzip_file(zip_file, tmp_dir)
+    if not glob.glob(os.path.join(tmp_dir, "*.nc")):
+        # A truncated or corrupt download: drop it so the next run downloads it again
+        logger.error(f"No netCDF file in {zip_file}, removing it from the cache")
+        os.remove(zip_file)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(extract_dir, ignore_errors=True)
+        return []
+
+    shutil.rmtree(extract_dir, ignore_errors=True)
+    os.replace(tmp_dir, extract_dir)
+    return sorted(glob.glob(os.path.join(extract_dir, "*.nc")))
+
+
+def publish_latest(nc_files, latest_dir):
+    """
+    Replaces the netCDF files of latest_dir with nc_files (hard links when possible).
+    """
+    os.makedirs(latest_dir, exist_ok=True)
+    for old_file in glob.glob(os.path.join(latest_dir, "*.nc")):
+        os.remove(old_file)
+    for nc_file in nc_files:
+        target = os.path.join(latest_dir, os.path.basename(nc_file))
+        try:
+            os.link(nc_file, target)
+        except OSError:
+            shutil.copy2(nc_file, target)
+
+
+def file_variables(nc_file):
+    """
+    Names of the gridded (latitude and longitude) data variables of a file.
+    """
+    with Dataset(nc_file, mode="r") as ds:
+        return [
+            name for name, variable in ds.variables.items()
+            if name not in ['longitude', 'latitude', 'time', 'level']
+            and "latitude" in variable.dimensions and "longitude" in variable.dimensions
+        ]
+
+
+# Orion client of a worker process, created on its first task
+_worker_orion = None
+
+
+def push_variable(nc_file, variable):
+    """
+    Worker task: streams one variable of one file to Orion.
+
+    Returns:
+        int: Number of entities Orion accepted.
+    """
+    global _worker_orion
+    if _worker_orion is None:
+        _worker_orion = OrionClient(ORION_URL, logger=logger)
+
+    entities = netcdf_to_orion_entities(
+        nc_file,
+        west = float(os.getenv('WEST')),
+        east = float(os.getenv('EAST')),
+        south = float(os.getenv('SOUTH')),
+        north = float(os.getenv('NORTH')),
+        region="Greece",
+        variables=[variable]
+    )
+    return _worker_orion.upsert_entities(entities)
+
+
+def process_files(nc_files, executor):
+    """
+    Streams the bbox cells of the files to Orion when SATELLITE_PUSH_TO_ORION
+    is set, one (file, variable) task per worker process.
+    """
+    if not PUSH_TO_ORION:
+        return 0
+
+    futures = [
+        executor.submit(push_variable, nc_file, variable)
+        for nc_file in nc_files
+        for variable in file_variables(nc_file)
+    ]
+    return sum(future.result() for future in futures)
+
+
+def download_stage(client, pending, downloads):
+    """
+    Pipeline stage 1: downloads and unzips every pending request in turn, so
+    the next download runs while the previous one is being processed.
+    """
     try:
-        data = json.loads(payload)
-        entity_id = data["id"]
-
-        url = f"{ORION_URL}/{entity_id}/attrs"
-
-        response = requests.patch(url, headers=headers, json={key: value for key, value in data.items() if key not in ["id", "type"]})
-
-        if response.status_code == 204:
-            logger.info(f"Data updated successfully! CAR ID: {entity_id}")
-        elif response.status_code == 404:  # Entity not found, create it
-            response = requests.post(ORION_URL, headers=headers, json=data)
-            if response.status_code == 201:
-                logger.info(f"Data created successfully! CAR ID: {entity_id}")
-            else:
-                logger.error(f"Failed to create entity: {response.status_code} - {response.text}")
-        else:
-            logger.error(f"Failed to send data: {response.status_code} - {response.text}")
-    except Exception as e:
-        logger.error(f"Error while sending data to Orion: {str(e)}")
+        for day_request, slices in pending:
+            try:
+                nc_files = download_cached(client, day_request, CACHE_DIR)
+            except Exception as e:
+                logger.error(f"Failed to download {day_request['date'][0]}: {str(e)}")
+                nc_files = []
+            downloads.put((day_request, slices, nc_files))
+    finally:
+        downloads.put(None)
 
 
 def main():
-    ## Step1: Get data and unzip them
+    ## Step1: Work out which (date, time, variable) slices are new
+
+    processed = load_ledger(LEDGER_FILE)
+    pending = missing_requests(current_request(), processed)
+    if not pending:
+        logger.info("All requested CAMS slices were already processed")
+        return
 
     client = cdsapi.Client()
-    client.retrieve(dataset, request, filename).download()
 
-    ## Step 2: Unzip and split file
+    # Spawned workers: the download thread is already running when they start
+    executor = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn")) if PUSH_TO_ORION else None
 
-    unzip_file(filename, "satellite_accumulated")
+    ## Step 2: Get data and unzip them, once per distinct request, one request ahead of step 3
 
-    split_nc_by_parameter(f"satellite_accumulated/{filename}", "satellite_by_parameter")
+    downloads = queue.Queue(maxsize=1)
+    downloader = threading.Thread(target=download_stage, args=(client, pending, downloads), name="cams-download", daemon=True)
+    downloader.start()
 
-    ## Step 3: nc->json
+    try:
+        while True:
+            item = downloads.get()
+            if item is None:
+                break
+            day_request, slices, nc_files = item
+            if not nc_files:
+                logger.error(f"No netCDF files in the download of {day_request['date'][0]}")
+                continue
 
-    nc_files = glob.glob("satellite_by_parameter/*.nc")
+            ## Step 3: hand them to the base layer and optionally stream them to orion
+
+            publish_latest(nc_files, LATEST_DIR)
+            logger.info(f"{len(nc_files)} CAMS file(s) of {day_request['date'][0]} in {LATEST_DIR} for the interpolation base layer")
+
+            process_files(nc_files, executor)
+
+            processed |= slices
+            save_ledger(LEDGER_FILE, processed)
+    finally:
+        # Unblock the download stage if processing stopped early
+        while downloader.is_alive():
+            try:
+                downloads.get(timeout=1)
+            except queue.Empty:
+                pass
+        if executor is not None:
+            executor.shutdown()
 
-    for file in nc_files:
-        netcdf_to_json_filtered(
-            file, 
-            f"satellite_by_parameter/{file.split('.')[0]}.json", 
-            west = float(os.getenv('WEST')),
-            east = float(os.getenv('EAST')),
-            south = float(os.getenv('SOUTH')),
-            north = float(os.getenv('NORTH'))
-    )
 
-    ## Step 3: post to orion
-    
-    json_files = glob.glob("satellite_by_parameter/*.json")
+# Held while a run is in progress, so the scheduler never starts a second one
+run_lock = threading.Lock()
+
+
+def run_in_background():
+    """
+    Starts main on its own thread so the scheduler loop is never blocked,
+    unless the previous run is still going.
+    """
+    if not run_lock.acquire(blocking=False):
+        logger.warning("Previous satellite run is still in progress, skipping this one")
+        return
 
-    for file in json_files:
-        with open(file, 'r') as f:
-            json_payload = json.load(f)
-        
-        entities = json_to_orion_entities(json_payload, region="Greece")
+    def run():
+        try:
+            main()
+        except Exception as e:
+            logger.error(f"Satellite run failed: {str(e)}")
+        finally:
+            run_lock.release()
 
-        for entity in entities:
-            send_data_to_orion(entity)
+    threading.Thread(target=run, name="satellite-run").start()
 
 if __name__=="__main__":
-    schedule.every().hour.do(main)
+    schedule.every().hour.do(run_in_background)
 
     while True:
         schedule.run_pending()
@@ -8,9 +8,17 @@ import requests
 import logging
 import logging.config
 from datetime import datetime
+import math
 import os
-from dotenv import load_dotenv
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+# The Orion client is shared by all accumulators
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from OrionClient import OrionClient
 
 load_dotenv()
 
@@ -30,90 +38,224 @@ lat_min, lat_max = float(os.getenv('SOUTH')), float(os.getenv('NORTH'))
 lon_min, lon_max = float(os.getenv('WEST')), float(os.getenv('EAST'))
 
 apiToken = os.getenv('STATION_API')
-url = f"https://api.waqi.info/map/bounds/?token={apiToken}&latlng={lat_min},{lon_min},{lat_max},{lon_max}"
+WAQI_BOUNDS_URL = "https://api.waqi.info/map/bounds/"
+
+# Large bboxes are fetched as tiles of at most TILE_SIZE degrees, each cached for CACHE_TTL seconds
+TILE_SIZE = float(os.getenv('STATION_TILE_SIZE', 20))
+CACHE_DIR = os.getenv('STATION_CACHE_DIR', "station_tiles")
+CACHE_TTL = float(os.getenv('STATION_CACHE_TTL', 3000))
+FETCH_WORKERS = int(os.getenv('STATION_FETCH_WORKERS', 4))
+FETCH_RATE_LIMIT = float(os.getenv('STATION_FETCH_RATE_LIMIT', 5))
+# Optional local file with WAQI station data, used instead of the API
+DATA_FILE = os.getenv('STATION_DATA_FILE')
+
+ORION_URL = os.getenv('ORION_URL')
+
+# What was last pushed to Orion for every station uid, so unchanged stations are skipped
+SNAPSHOT_FILE = os.getenv('STATION_SNAPSHOT_FILE', "station_snapshot.json")
+# Concurrent Orion requests and their rate limit (requests per second)
+ORION_WORKERS = int(os.getenv('STATION_ORION_WORKERS', 4))
+ORION_RATE_LIMIT = float(os.getenv('STATION_ORION_RATE_LIMIT', 10))
+ORION_BATCH_SIZE = int(os.getenv('STATION_ORION_BATCH_SIZE', 500))
+
+
+class RateLimiter:
+    """
+    Spaces calls of wait() at least 1 / per_second seconds apart across threads.
+    """
+
+    def __init__(self, per_second: float):
+        self.interval = 1.0 / per_second if per_second else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def bbox_tiles(south, west, north, east, tile_size):
+    """
+    Splits a bbox into a grid of (south, west, north, east) tiles of at most tile_size degrees.
+    """
+    rows = max(1, math.ceil((north - south) / tile_size))
+    cols = max(1, math.ceil((east - west) / tile_size))
+    lat_step = (north - south) / rows
+    lon_step = (east - west) / cols
+    return [
+        (round(south + i * lat_step, 6), round(west + j * lon_step, 6),
+         round(south + (i + 1) * lat_step, 6), round(west + (j + 1) * lon_step, 6))
+        for i in range(rows) for j in range(cols)
+    ]
 
-ORION_URL = os.getenv('ORION_URL')+"/entities"
 
+def tile_cache_file(tile):
+    return os.path.join(CACHE_DIR, "waqi_{}_{}_{}_{}.json".format(*tile))
 
-def load_data(data_file):
-    if os.path.exists(data_file):
+
+def fetch_tile(tile, session, rate_limiter):
+    """
+    Stations of one tile, from the cache while it is younger than CACHE_TTL.
+
+    When the API call fails an expired cache entry is still used.
+    """
+    cache_file = tile_cache_file(tile)
+    cached = os.path.exists(cache_file)
+    if cached and time.time() - os.path.getmtime(cache_file) < CACHE_TTL:
+        with open(cache_file, "r") as file:
+            return json.load(file)
+
+    try:
+        rate_limiter.wait()
+        south, west, north, east = tile
+        response = session.get(WAQI_BOUNDS_URL, params={"token": apiToken, "latlng": f"{south},{west},{north},{east}"},
+                               timeout=30)
+        body = response.json()
+        if body.get("status") != "ok":
+            raise ValueError(f"WAQI answered {body.get('status')}: {body.get('data')}")
+        data = body["data"]
+    except Exception as e:
+        logger.error(f"Failed to fetch tile {tile}: {str(e)}")
+        if cached:
+            with open(cache_file, "r") as file:
+                return json.load(file)
+        return None
+
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, "w") as file:
+        json.dump(data, file)
+    os.replace(tmp_file, cache_file)
+    return data
+
+
+def load_data(data_file=None):
+    if data_file and os.path.exists(data_file):
         with open(data_file, "r") as file:
             data = json.load(file)
         return data, "Fetched from local file"
-    else:
-        logger.info("Fetching data...")
-        try:
-            response = requests.get(url)
-            data = response.json()['data']
-            with open(data_file, "w") as file:
-                json.dump(data, file)
-            return data, "Fetched from api"
-        except Exception as e:
-            logger.error(f"An error occurred: {str(e)}")
-            return None, f"An error occurred: {str(e)}"
-
-
-def send_data_to_orion(payload):
-    """Send data to Orion Context Broker."""
-    headers = {
-        "Content-Type": "application/json"
-    }
+
+    logger.info("Fetching data...")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tiles = bbox_tiles(lat_min, lon_min, lat_max, lon_max, TILE_SIZE)
+    rate_limiter = RateLimiter(FETCH_RATE_LIMIT)
+
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        results = list(executor.map(lambda tile: fetch_tile(tile, session, rate_limiter), tiles))
+
+    failed = sum(result is None for result in results)
+    if failed == len(tiles):
+        return None, "An error occurred: no tile could be fetched"
+
+    # Stations on a shared tile border are returned by both tiles
+    stations = {}
+    for result in results:
+        for station in result or []:
+            stations.setdefault(station["uid"], station)
+
+    return list(stations.values()), f"Fetched {len(stations)} stations from {len(tiles) - failed}/{len(tiles)} tiles"
+
+
+def load_snapshot(snapshot_file):
+    if not os.path.exists(snapshot_file):
+        return {}
     try:
-        # Remove json.loads, as payload is already a dictionary
-        entity_id = payload["id"]
-
-        url = f"{ORION_URL}/{entity_id}/attrs"
-
-        response = requests.patch(url, headers=headers, json={key: value for key, value in payload.items() if key not in ["id", "type"]})
-
-        if response.status_code == 204:
-            logger.info(f"Data updated successfully! CAR ID: {entity_id}")
-        elif response.status_code == 404:  # Entity not found, create it
-            response = requests.post(ORION_URL, headers=headers, json=payload)
-            if response.status_code == 201:
-                logger.info(f"Data created successfully! CAR ID: {entity_id}")
-            else:
-                logger.error(f"Failed to create entity: {response.status_code} - {response.text}")
-                #print(f"\n\n{payload}\n\n")
-        else:
-            logger.error(f"Failed to send data: {response.status_code} - {response.text}")
+        with open(snapshot_file, "r") as file:
+            return json.load(file)
     except Exception as e:
-        logger.error(f"Error while sending data to Orion: {str(e)}")
+        logger.error(f"Ignoring unreadable snapshot {snapshot_file}: {str(e)}")
+        return {}
 
-def main():
-    data_file = "station_aqi_data.json"
 
-    data, message = load_data(data_file)
+def save_snapshot(snapshot_file, snapshot):
+    tmp_file = f"{snapshot_file}.tmp"
+    with open(tmp_file, "w") as file:
+        json.dump(snapshot, file)
+    os.replace(tmp_file, snapshot_file)
+
+
+def station_state(station):
+    """
+    The part of a WAQI station that ends up in Orion, as stored in the snapshot.
+    """
+    return [station["aqi"], station["lat"], station["lon"]]
 
-    logger.info(message)
 
+def changed_stations(data, snapshot):
+    """
+    Splits the fetched stations into the ones whose state differs from the snapshot.
+
+    Returns:
+        tuple: (changed stations, snapshot updated with their new state)
+    """
+    changed = []
+    updated = dict(snapshot)
     for station in data:
-        payload = {  
-            "id": f"station_{station['uid']}",  
-            "type": "StationAirQualityObserved",  
-            "dateObserved": {  
-                "type": "DateTime",  
-                "value": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z') #station["station"]["time"]
-            },   
-            "aqi": {  
-                "type": "Float",  
-                "value": station["aqi"]
-            }, 
-            "location": {  
-                "type": "geo:json",  
-                "value": {  
-                "type": "Point",  
-                "coordinates": [  
-                    station["lat"],
-                    station["lon"]
-                ]  
-                }  
-            }
+        uid = str(station["uid"])
+        state = station_state(station)
+        if updated.get(uid) != state:
+            changed.append(station)
+            updated[uid] = state
+    return changed, updated
+
+
+def to_orion_entity(station):
+    return {  
+        "id": f"station_{station['uid']}",  
+        "type": "StationAirQualityObserved",  
+        "dateObserved": {  
+            "type": "DateTime",  
+            "value": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z') #station["station"]["time"]
+        },   
+        "aqi": {  
+            "type": "Float",  
+            "value": station["aqi"]
+        }, 
+        "location": {  
+            "type": "geo:json",  
+            "value": {  
+            "type": "Point",  
+            "coordinates": [  
+                station["lat"],
+                station["lon"]
+            ]  
+            }  
         }
+    }
+
+
+def main():
+    data, message = load_data(DATA_FILE)
+
+    logger.info(message)
 
-        time.sleep(0.1)
+    if data is None:
+        return
 
-        send_data_to_orion(payload)
+    snapshot = load_snapshot(SNAPSHOT_FILE)
+    changed, updated_snapshot = changed_stations(data, snapshot)
+    logger.info(f"{len(changed)} of {len(data)} stations changed since the last sync")
+
+    if not changed:
+        return
+
+    orion = OrionClient(ORION_URL, batch_size=ORION_BATCH_SIZE, max_workers=ORION_WORKERS,
+                        max_requests_per_second=ORION_RATE_LIMIT, logger=logger)
+    try:
+        sent = orion.upsert_entities(to_orion_entity(station) for station in changed)
+    finally:
+        orion.close()
+
+    # On a partial failure the old snapshot is kept, so the next run resends every changed station
+    if sent == len(changed):
+        save_snapshot(SNAPSHOT_FILE, updated_snapshot)
+    else:
+        logger.error(f"Only {sent} of {len(changed)} changed stations reached Orion, snapshot not updated")
 
 if __name__=="__main__":
     main()
\ No newline at end of file
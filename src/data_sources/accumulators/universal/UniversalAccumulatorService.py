@@ -0,0 +1,345 @@
+"""
+Long running service polling many AQI providers through universal_accumulator.
+
+Every *.json file of UNIVERSAL_SOURCES_DIR is one source: a universal
+accumulator config ("case" and "mapping") plus where and how often to fetch
+
+    {
+        "name": "waqi-greece",             optional, defaults to the file name
+        "url": "https://api.example.org/stations",
+        "params": {"token": "${TOKEN}"},   optional query parameters
+        "headers": {},                     optional request headers
+        "interval": 900,                   optional seconds, UNIVERSAL_DEFAULT_INTERVAL
+        "jitter": 0.1,                     optional fraction of the interval, UNIVERSAL_JITTER
+        "payloadPath": ["data"],           optional path of the array inside a wrapped payload
+        "case": 4,
+        "mapping": {...}
+    }
+
+${VAR} references in url, params and headers are replaced by environment
+variables, so tokens stay in .env. sources/waqi.json.example is a complete
+example, copy it to a .json file to enable it (it overlaps the WAQI stations
+StationDataAccumulator already ingests).
+
+Every source is polled on its own interval, shifted by a random jitter so
+sources with the same interval do not fire together. Fetches run on a
+shared thread pool, with at most UNIVERSAL_HOST_CONNECTIONS requests per
+host at a time over one keep-alive session. Top level array payloads are
+parsed while they download (universal_accumulator.stream_payload) and
+upserted to Orion batch by batch. Payloads under payloadPath are read
+whole.
+"""
+
+import heapq
+import json
+import logging
+import logging.config
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+# The universal accumulator and the Orion client live one level up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from OrionClient import OrionClient
+from universal_accumulator import load_config, process_payload, stream_payload, get_value_from_payload
+
+load_dotenv()
+
+logging.config.fileConfig('../../../logging.conf')
+logger = logging.getLogger('UNIVERSAL_DATA')
+
+ORION_URL = os.getenv('ORION_URL')
+
+SOURCES_DIR = os.getenv('UNIVERSAL_SOURCES_DIR', "sources")
+# Poll interval (seconds) and jitter (fraction of the interval) of sources that do not set their own
+DEFAULT_INTERVAL = float(os.getenv('UNIVERSAL_DEFAULT_INTERVAL', 3600))
+DEFAULT_JITTER = float(os.getenv('UNIVERSAL_JITTER', 0.1))
+# Concurrent fetches in total and per provider host
+FETCH_WORKERS = int(os.getenv('UNIVERSAL_FETCH_WORKERS', 16))
+HOST_CONNECTIONS = int(os.getenv('UNIVERSAL_HOST_CONNECTIONS', 2))
+FETCH_TIMEOUT = float(os.getenv('UNIVERSAL_FETCH_TIMEOUT', 60))
+REPORT_INTERVAL = float(os.getenv('UNIVERSAL_REPORT_INTERVAL', 300))
+# Seconds between two scans of an empty sources directory
+RESCAN_INTERVAL = float(os.getenv('UNIVERSAL_RESCAN_INTERVAL', 60))
+# Posting threads of one upsert, and Orion requests in flight across all concurrent polls
+ORION_WORKERS = int(os.getenv('UNIVERSAL_ORION_WORKERS', 4))
+ORION_CONNECTIONS = int(os.getenv('UNIVERSAL_ORION_CONNECTIONS', 8))
+# Rate limit of the Orion requests (requests per second)
+ORION_RATE_LIMIT = float(os.getenv('UNIVERSAL_ORION_RATE_LIMIT', 20))
+ORION_BATCH_SIZE = int(os.getenv('UNIVERSAL_ORION_BATCH_SIZE', 500))
+
+
+def expand_env(value):
+    """
+    Replaces ${VAR} references in a string, or in the values of a dict, by environment variables.
+    """
+    if isinstance(value, str):
+        return os.path.expandvars(value)
+    if isinstance(value, dict):
+        return {key: expand_env(item) for key, item in value.items()}
+    return value
+
+
+def load_sources(sources_dir):
+    """
+    Loads every source config of the directory, with its mapping compiled once by load_config.
+
+    Unreadable configs are logged and skipped, so one broken provider does not stop the others.
+    """
+    sources = []
+    if not os.path.isdir(sources_dir):
+        return sources
+    for file_name in sorted(os.listdir(sources_dir)):
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            config = load_config(os.path.join(sources_dir, file_name))
+            config.setdefault("name", os.path.splitext(file_name)[0])
+            config.setdefault("interval", DEFAULT_INTERVAL)
+            config.setdefault("jitter", DEFAULT_JITTER)
+            if not config.get("url"):
+                raise ValueError("missing url")
+            for key in ("url", "params", "headers"):
+                if key in config:
+                    config[key] = expand_env(config[key])
+            sources.append(config)
+        except Exception as e:
+            logger.error(f"Skipping source config {file_name}: {str(e)}")
+    return sources
+
+
+def to_orion_entity(sdm):
+    """
+    NGSI v2 entity of a mapped record: map_to_sdm keeps id and type as
+    {"type", "value"} attributes, Orion needs them as plain strings.
+    """
+    entity = dict(sdm)
+    entity["id"] = str(sdm["id"]["value"])
+    entity["type"] = str(sdm["type"]["value"])
+    return entity
+
+
+class SourceStats:
+    """
+    Poll counters of one source, updated by the fetch threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.polls = 0
+        self.failed = 0
+        self.skipped = 0
+        self.records = 0
+        self.sent = 0
+        self.last_latency = None
+        self.last_records = 0
+        self.last_duration = None
+        self._latency_total = 0.0
+
+    def record_poll(self, latency, records, sent, duration):
+        with self._lock:
+            self.polls += 1
+            self.records += records
+            self.sent += sent
+            self.last_latency = latency
+            self.last_records = records
+            self.last_duration = duration
+            self._latency_total += latency
+
+    def record_failure(self):
+        with self._lock:
+            self.polls += 1
+            self.failed += 1
+
+    def record_skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            succeeded = self.polls - self.failed
+            return {
+                "polls": self.polls,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "records": self.records,
+                "sent": self.sent,
+                "last_latency": self.last_latency,
+                "avg_latency": self._latency_total / succeeded if succeeded else None,
+                "last_records": self.last_records,
+                "last_duration": self.last_duration,
+            }
+
+
+class PollingScheduler:
+    """
+    Polls every source on its own jittered interval and upserts its records to Orion.
+
+    A source whose previous poll is still running when it is due again is
+    skipped for that round instead of piling up fetches.
+    """
+
+    def __init__(self, sources, orion: OrionClient, fetch_workers: int = FETCH_WORKERS,
+                 host_connections: int = HOST_CONNECTIONS, timeout: float = FETCH_TIMEOUT):
+        self.sources = sources
+        self.orion = orion
+        self.fetch_workers = fetch_workers
+        self.host_connections = host_connections
+        self.timeout = timeout
+        self.stats = {source["name"]: SourceStats() for source in sources}
+
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+        self._running = set()
+        self._running_lock = threading.Lock()
+
+        hosts = {urlsplit(source["url"]).netloc for source in sources}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(1, len(hosts)), pool_maxsize=host_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def host_slot(self, url) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.host_connections)
+            return self._host_slots[host]
+
+    def next_due(self, source, now):
+        interval = float(source["interval"])
+        return now + interval + random.uniform(-1, 1) * interval * float(source["jitter"])
+
+    def fetch_records(self, source, response):
+        if source.get("payloadPath"):
+            payload = get_value_from_payload(response.json(), source["payloadPath"])
+            return iter(process_payload(source, payload, source["case"]))
+        return stream_payload(source, response, source["case"])
+
+    def poll(self, source):
+        """
+        Fetches one source and upserts its records.
+
+        The host slot is held until the response is fully read, as the
+        records are parsed and sent while the body is still downloading.
+        """
+        name = source["name"]
+        stats = self.stats[name]
+        counted = [0]
+
+        def counting(records):
+            for record in records:
+                counted[0] += 1
+                yield to_orion_entity(record)
+
+        try:
+            with self.host_slot(source["url"]):
+                started = time.monotonic()
+                with self.session.get(source["url"], params=source.get("params"), headers=source.get("headers"),
+                                      timeout=self.timeout, stream=True) as response:
+                    latency = time.monotonic() - started
+                    response.raise_for_status()
+                    sent = self.orion.upsert_entities(counting(self.fetch_records(source, response)))
+                duration = time.monotonic() - started
+            stats.record_poll(latency, counted[0], sent, duration)
+            logger.info(f"Source '{name}': {counted[0]} records, {sent} sent to Orion, "
+                        f"fetch latency {latency:.2f}s, poll {duration:.2f}s")
+        except Exception as e:
+            stats.record_failure()
+            logger.error(f"Failed to poll source '{name}' after {counted[0]} records: {str(e)}")
+        finally:
+            with self._running_lock:
+                self._running.discard(name)
+
+    def submit(self, executor, source):
+        name = source["name"]
+        with self._running_lock:
+            if name in self._running:
+                self.stats[name].record_skip()
+                logger.warning(f"Source '{name}' is still being polled, skipping this round")
+                return
+            self._running.add(name)
+        executor.submit(self.poll, source)
+
+    def run(self, stop: threading.Event):
+        """
+        Runs until stop is set. The first poll of every source is spread over
+        its jitter window, so a restart does not hit all providers at once.
+        """
+        now = time.monotonic()
+        due = [(now + random.uniform(0, float(source["interval"]) * float(source["jitter"])), k, source)
+               for k, source in enumerate(self.sources)]
+        heapq.heapify(due)
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            while due and not stop.is_set():
+                when, k, source = due[0]
+                if stop.wait(max(0.0, when - time.monotonic())):
+                    break
+                heapq.heapreplace(due, (self.next_due(source, when), k, source))
+                self.submit(executor, source)
+
+    def report(self):
+        for name, stats in self.stats.items():
+            stats = stats.snapshot()
+            latency = f"{stats['avg_latency']:.2f}s" if stats["avg_latency"] is not None else "-"
+            logger.info(
+                f"Source '{name}': {stats['polls']} polls, {stats['failed']} failed, {stats['skipped']} skipped, "
+                f"{stats['records']} records, {stats['sent']} sent, {stats['last_records']} in the last poll, "
+                f"avg fetch latency {latency}"
+            )
+
+    def close(self):
+        self.session.close()
+
+
+def report_forever(scheduler, stop):
+    while not stop.wait(REPORT_INTERVAL):
+        scheduler.report()
+
+
+def wait_for_sources(sources_dir):
+    """
+    Loads the source configs, rescanning every RESCAN_INTERVAL seconds while
+    there are none, so an empty directory idles instead of restarting the container.
+    """
+    while True:
+        sources = load_sources(sources_dir)
+        if sources:
+            return sources
+        logger.warning(f"No source config in {sources_dir}, checking again in {RESCAN_INTERVAL:.0f}s")
+        time.sleep(RESCAN_INTERVAL)
+
+
+def main():
+    sources = wait_for_sources(SOURCES_DIR)
+    logger.info(f"Loaded {len(sources)} source(s) from {SOURCES_DIR}: {json.dumps([s['name'] for s in sources])}")
+
+    # Shared by every poll: the pool holds ORION_CONNECTIONS keep-alive connections and never more requests run
+    orion = OrionClient(ORION_URL, batch_size=ORION_BATCH_SIZE, max_workers=ORION_WORKERS,
+                        max_requests_per_second=ORION_RATE_LIMIT, max_connections=ORION_CONNECTIONS, logger=logger)
+    scheduler = PollingScheduler(sources, orion)
+    stop = threading.Event()
+    threading.Thread(target=report_forever, args=(scheduler, stop), name="universal-report", daemon=True).start()
+
+    try:
+        scheduler.run(stop)
+    except KeyboardInterrupt:
+        logger.info("Stopping")
+    finally:
+        stop.set()
+        scheduler.report()
+        scheduler.close()
+        orion.close()
+
+
+if __name__ == "__main__":
+    main()
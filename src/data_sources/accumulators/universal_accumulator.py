@@ -1,6 +1,8 @@
+import codecs
+import copy
 import json
 from datetime import datetime
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Iterator, Union
 
 # Smart Data Model Template
 SMART_DATA_MODEL_TEMPLATE = {
@@ -36,71 +38,187 @@ def get_value_from_payload(data: Dict[str, Any], keys: List[Union[str, int]]) ->
             return None
     return data
 
-def map_to_sdm(config: Dict[str, Any], payload: Union[Dict[str, Any], List], position: int = None) -> Dict[str, Any]:
+# Marks a key missing from a dict payload in the compiled accessors
+_MISSING = object()
+
+# Mapping keys whose static value is kept as is instead of converted to float
+_RAW_KEYS = ("id", "type", "dateObserved", "location")
+
+def new_sdm() -> Dict[str, Any]:
     """
-    Maps data from the payload to the Smart Data Model format based on the provided configuration.
+    A fresh SMART_DATA_MODEL_TEMPLATE, with no nested dict shared between records.
     """
-    sdm = SMART_DATA_MODEL_TEMPLATE.copy()
+    return {
+        "id": "",
+        "type": "SensorAirQualityObserved",
+        "dateObserved": {
+            "type": "DateTime",
+            "value": ""
+        },
+        "aqi": {
+            "type": "Number",
+            "value": 0.0
+        },
+        "location": {
+            "type": "geo:json",
+            "value": {
+                "type": "Point",
+                "coordinates": []
+            }
+        }
+    }
 
-    for key, mapping in config["mapping"].items():
-        if mapping["getFromPayload"]:
-            value = get_value_from_payload(payload, mapping["value"])
-            if value in mapping.get("expectInCaseOfMissing", []):
-                value = 10  # Default AQI if missing or invalid
-            else:
-                try:
-                    value = float(value)
-                except Exception:
-                    value = 10  # Default if conversion fails
-        else:
-            if str(key) in ["id", "type", "dateObserved", "location"]:
-                value = mapping["value"]
+def compile_accessor(keys: List[Union[str, int]]):
+    """
+    Compiles a key path into a function equivalent to get_value_from_payload(payload, keys).
+
+    Dict steps and int steps into lists take a single lookup, anything else
+    falls back to the generic rules.
+    """
+    keys = tuple(keys)
+
+    def access(data):
+        for key in keys:
+            if type(data) is dict:
+                data = data.get(key, _MISSING)
+                if data is _MISSING:
+                    return None
+            elif type(data) is list and type(key) is int:
+                data = data[key]
+            elif isinstance(data, (list, dict)) and key in data:
+                data = data[key]
+            elif isinstance(data, list) and isinstance(key, int):
+                data = data[key]
             else:
-                try:
-                    value = float(mapping["value"])
-                except Exception:
-                    value = 10  # Default if conversion fails
+                return None
+        return data
+
+    return access
+
+def _compile_value(key: str, mapping: Dict[str, Any]):
+    """
+    Compiles how map_to_sdm obtains the value of one mapped key.
+
+    Returns:
+        tuple: (function of the payload or None, constant used when the function is None)
+    """
+    if key == "location":
+        accessors = tuple(compile_accessor(coord_keys) for coord_keys in mapping["value"]["coordinates"])
+        return (lambda payload: {"type": "Point", "coordinates": [access(payload) for access in accessors]}), None
+
+    if mapping["getFromPayload"]:
+        access = compile_accessor(mapping["value"])
+        missing = tuple(mapping.get("expectInCaseOfMissing", []))
+
+        def extract(payload):
+            value = access(payload)
+            if value in missing:
+                return 10  # Default AQI if missing or invalid
+            try:
+                return float(value)
+            except Exception:
+                return 10  # Default if conversion fails
+
+        return extract, None
+
+    if key == "id" and mapping.get("fromPayload"):
+        # "$name$" in the id is replaced by the payload value at fromPayload[name], e.g. a provider's station uid
+        template = mapping["value"]
+        fields = tuple((f"${name}$", compile_accessor(keys)) for name, keys in mapping["fromPayload"].items())
+
+        def format_id(payload):
+            value = template
+            for placeholder, access in fields:
+                value = value.replace(placeholder, str(access(payload)))
+            return value
+
+        return format_id, None
+
+    if str(key) in _RAW_KEYS:
+        value = mapping["value"]
+        if isinstance(value, (dict, list)):
+            return (lambda payload: copy.deepcopy(value)), None
+        return None, value
+
+    try:
+        return None, float(mapping["value"])
+    except Exception:
+        return None, 10  # Default if conversion fails
+
+class MappingPlan:
+    """
+    A config["mapping"] compiled once into accessors and converters.
+
+    Calling the plan on a payload gives the same record map_to_sdm used to
+    build by interpreting the mapping for every record, but every record is
+    a fresh object.
+    """
 
-        if key == "id" and position is not None:
-            value = value.replace("$position$", str(position))
+    def __init__(self, mapping: Dict[str, Any]):
+        self.steps = []
+        for key, key_mapping in mapping.items():
+            extract, constant = _compile_value(key, key_mapping)
+            self.steps.append((key, key_mapping.get("type", ""), extract, constant))
 
-        if key == "location":
-            coordinates = [
-                get_value_from_payload(payload, coord_keys)
-                for coord_keys in mapping["value"]["coordinates"]
-            ]
-            value = {"type": "Point", "coordinates": coordinates}
+    def __call__(self, payload: Union[Dict[str, Any], List], position: int = None) -> Dict[str, Any]:
+        sdm = new_sdm()
 
-        sdm[key] = {"type": mapping.get("type", ""), "value": value}
+        for key, value_type, extract, constant in self.steps:
+            value = constant if extract is None else extract(payload)
+            if key == "id" and position is not None:
+                value = value.replace("$position$", str(position))
+            sdm[key] = {"type": value_type, "value": value}
 
-    sdm["dateObserved"]["value"] = datetime.utcnow().isoformat()
-    sdm["id"]["type"] = "String" if type(sdm["id"]["value"]) == str else "Number"
-    sdm["type"]["type"] = "String" if type(sdm["type"]["value"]) == str else "Number"
-    return sdm
+        sdm["dateObserved"]["value"] = datetime.utcnow().isoformat()
+        sdm["id"]["type"] = "String" if type(sdm["id"]["value"]) == str else "Number"
+        sdm["type"]["type"] = "String" if type(sdm["type"]["value"]) == str else "Number"
+        return sdm
+
+def compile_mapping(mapping: Dict[str, Any]) -> MappingPlan:
+    """
+    Compiles config["mapping"] into a MappingPlan.
+    """
+    return MappingPlan(mapping)
+
+def config_plan(config: Dict[str, Any]) -> MappingPlan:
+    """
+    The compiled mapping of a config, compiled on the spot for configs not
+    created by load_config.
+    """
+    plan = config.get("plan")
+    if plan is None:
+        plan = compile_mapping(config["mapping"])
+    return plan
+
+def map_to_sdm(config: Dict[str, Any], payload: Union[Dict[str, Any], List], position: int = None) -> Dict[str, Any]:
+    """
+    Maps data from the payload to the Smart Data Model format based on the provided configuration.
+    """
+    return config_plan(config)(payload, position)
 
 def process_payload(config: Dict[str, Any], payload: Union[Dict[str, Any], List], case: int) -> List[Dict[str, Any]]:
     """
     Processes the payload based on the specified case.
     """
     results = []
+    plan = config_plan(config)
 
     if case == 1:
-        results.append(map_to_sdm(config, payload))
+        results.append(plan(payload))
 
     elif case == 2:
         if isinstance(payload, list):
-            for position, element in enumerate(payload):
-                results.append(map_to_sdm(config, element, position))
+            results = [plan(element, position) for position, element in enumerate(payload)]
 
     elif case == 3:
-        sdm = map_to_sdm(config, payload)
+        sdm = plan(payload)
         sdm["aqi"]["value"] = convert_to_aqi(sdm["aqi"]["value"])
         results.append(sdm)
 
     elif case == 4:
         if isinstance(payload, list):
             for position, element in enumerate(payload):
-                sdm = map_to_sdm(config, element, position)
+                sdm = plan(element, position)
                 sdm["aqi"]["value"] = convert_to_aqi(sdm["aqi"]["value"])
                 results.append(sdm)
 
@@ -115,12 +233,133 @@ def convert_to_aqi(value: Any) -> float:
     except (TypeError, ValueError):
         return 10.0
 
+# Characters read per step when streaming a payload
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = " \t\n\r"
+# Characters ending a scalar array element (number, true, false, null)
+_DELIMITERS = _WHITESPACE + ",]"
+
+def read_chunks(source, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[str]:
+    """
+    Reads a payload source as text chunks.
+
+    The source is a path, a file object, an HTTP response opened with
+    requests' stream=True or any iterable of str or bytes chunks. Bytes are
+    decoded as UTF-8, also when a character is split between two chunks.
+    """
+    if isinstance(source, str):
+        with open(source, "r", encoding="utf-8") as file:
+            yield from read_chunks(file, chunk_size)
+        return
+
+    if hasattr(source, "iter_content"):
+        chunks = source.iter_content(chunk_size)
+    elif hasattr(source, "read"):
+        chunks = iter(lambda: source.read(chunk_size), source.read(0))
+    else:
+        chunks = source
+
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in chunks:
+        yield text_decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+    tail = text_decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+def iter_json_array(source, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Any]:
+    """
+    Parses a JSON array payload element by element with JSONDecoder.raw_decode,
+    so only the element being decoded and one chunk are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    chunks = read_chunks(source, chunk_size)
+    buffer, position, eof = "", 0, False
+    started, expect_element, after_comma = False, True, False
+
+    def more():
+        nonlocal buffer, position, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof, chunk = True, ""
+        buffer, position = buffer[position:] + chunk, 0
+
+    while True:
+        while position < len(buffer) and buffer[position] in _WHITESPACE:
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError("Payload ended before the JSON array was closed" if started else "Empty payload")
+            more()
+            continue
+
+        if not started:
+            if buffer[position] != "[":
+                raise ValueError(f"Expected a JSON array payload, got {buffer[position]!r}")
+            started, position = True, position + 1
+            continue
+        if buffer[position] == "]" and not after_comma:
+            return
+        if not expect_element:
+            if buffer[position] != ",":
+                raise ValueError(f"Expected ',' or ']' at {buffer[position]!r} in the JSON array")
+            expect_element, after_comma, position = True, True, position + 1
+            continue
+
+        scalar = buffer[position] not in '"[{'
+        if scalar:
+            # A scalar only ends at a delimiter, which may still be in a later chunk ("1." + "5")
+            token_end = position
+            while token_end < len(buffer) and buffer[token_end] not in _DELIMITERS:
+                token_end += 1
+            if token_end == len(buffer) and not eof:
+                more()
+                continue
+
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof or scalar:
+                raise
+            more()
+            continue
+        if scalar and end != token_end:
+            raise ValueError(f"Invalid JSON value {buffer[position:token_end]!r} in the JSON array")
+        position = end
+        expect_element, after_comma = False, False
+        yield element
+
+def stream_payload(config: Dict[str, Any], source, case: int, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+    """
+    Lazy process_payload over a payload source (see read_chunks).
+
+    Array cases (2 and 4) are parsed element by element and every record is
+    yielded as soon as its element is mapped, so memory stays flat and the
+    records can go straight to OrionClient.upsert_entities, which sends each
+    batch while the rest of the payload is still being parsed. Single object
+    cases (1 and 3) are parsed whole.
+    """
+    if case not in (2, 4):
+        payload = json.loads("".join(read_chunks(source, chunk_size)))
+        yield from process_payload(config, payload, case)
+        return
+
+    plan = config_plan(config)
+    for position, element in enumerate(iter_json_array(source, chunk_size)):
+        sdm = plan(element, position)
+        if case == 4:
+            sdm["aqi"]["value"] = convert_to_aqi(sdm["aqi"]["value"])
+        yield sdm
+
 def load_config(file_path: str) -> Dict[str, Any]:
     """
-    Loads the configuration from a JSON file.
+    Loads the configuration from a JSON file and compiles its mapping once
+    into config["plan"].
     """
     with open(file_path, "r") as file:
-        return json.load(file)
+        config = json.load(file)
+    config["plan"] = compile_mapping(config["mapping"])
+    return config
 
 if __name__ == "__main__":
     config_path = "config.json"  # Path to the configuration file